@@ -23,6 +23,10 @@ def sidebar():
     preretrieval_method = st.sidebar.radio("Pre-retrieval method", ("なし", "クエリ拡張"))
     # 検索後処理
     postretrieval_method = st.sidebar.radio("Post-retrieval method", ("なし", "検索結果の関連度評価"))
+    # RRF で統合した検索結果のうち、評価・生成に使う上位件数
+    fusion_top_n = st.sidebar.number_input("Fusion top N", min_value=1, max_value=50, value=10)
+    # 類似の質問に対してキャッシュ済みの回答を返す
+    semantic_cache = st.sidebar.checkbox("Semantic cache")
     return {
         #"use_advanced_rag": use_advanced_rag,
         "run_rag": run_rag,
@@ -31,4 +35,6 @@ def sidebar():
         "generator_model_id": generator_model_id,
         "preretrieval_method": preretrieval_method,
         "postretrieval_method": postretrieval_method,
+        "fusion_top_n": fusion_top_n,
+        "semantic_cache": semantic_cache,
     }
@@ -0,0 +1,4 @@
+import pytest
+import os
+import sys
+sys.path.append(os.path.dirname(__file__))
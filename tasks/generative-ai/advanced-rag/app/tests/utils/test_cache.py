@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+
+from utils.cache import AnswerCache, LRUCache, SemanticCache, normalize_question
+
+SETTINGS = {"aws_region": "us-west-2", "kendra_index_id": "index", "fusion_top_n": 10}
+
+
+class TestCache():
+
+    def test_normalize_question(self):
+        assert normalize_question("Kendra とは？ ") == normalize_question("kendra  とは?")
+        assert normalize_question("ＡＷＳ　Ｋｅｎｄｒａ。") == "aws kendra"
+        assert normalize_question("Kendra とは") != normalize_question("Bedrock とは")
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None, "The least recently used entry should be evicted"
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        assert (cache.hits, cache.misses) == (3, 1)
+
+    def test_lru_cache_ttl(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        assert cache.get("a", "expired") == "expired"
+        assert len(cache.entries) == 0
+
+    def test_semantic_cache(self):
+        cache = SemanticCache(max_size=2, ttl=60, threshold=0.9)
+        cache.add("ns", [1.0, 0.0], "x")
+        cache.add("ns", [0.0, 1.0], "y")
+        assert cache.lookup("ns", [1.0, 0.1]) == "x"
+        assert cache.lookup("ns", [1.0, 1.0]) is None, "Below the threshold should miss"
+        assert cache.lookup("other", [1.0, 0.0]) is None, "Other namespaces should miss"
+        cache.add("ns", [-1.0, 0.0], "z")
+        assert cache.lookup("ns", [1.0, 0.0]) is None, "The oldest entry should be evicted"
+        assert cache.lookup("ns", [0.0, 1.0]) == "y"
+
+    def test_answer_cache_reports_matched_question(self):
+        vectors = {"kendra とは": [1.0, 0.0], "kendra って何": [0.99, 0.05], "bedrock とは": [0.0, 1.0]}
+        cache = AnswerCache(lambda text, settings: np.array(vectors[text]), threshold=0.95)
+        assert cache.get("Kendra とは?", SETTINGS, semantic=True)[0] is None
+        cache.put("Kendra とは?", SETTINGS, "answer", semantic=True)
+
+        value, question, vector = cache.get("kendra とは", SETTINGS)
+        assert (value, question, vector) == ("answer", "Kendra とは?", None)
+        value, question, _ = cache.get("Kendra って何", SETTINGS, semantic=True)
+        assert (value, question) == ("answer", "Kendra とは?"), "A semantic hit should name the cached question"
+        assert cache.get("Kendra って何", SETTINGS)[0] is None, "Without semantic only exact matches hit"
+        assert cache.get("Bedrock とは", SETTINGS, semantic=True)[0] is None
+        assert cache.get("Kendra とは?", dict(SETTINGS, fusion_top_n=5), semantic=True)[0] is None
@@ -1,13 +1,14 @@
 import re
 import yaml
+import hashlib
 import logging
 import asyncio
+import unicodedata
+from functools import lru_cache
 from typing import Dict, TypedDict
 
 import langchain
 from langchain_core.messages import BaseMessage
-from langchain_aws import AmazonKendraRetriever
-from langchain_aws import ChatBedrock
 from langchain_core.prompts import (
     ChatPromptTemplate,
     PromptTemplate,
@@ -23,6 +24,10 @@ from langchain_core.pydantic_v1 import (
 )
 from langgraph.graph import END, StateGraph
 
+from utils.async_utils import call_with_retry
+from utils.cache import grade_cache, retrieval_cache
+from utils.clients import get_chat_model, get_kendra_retriever
+
 #import settings
 
 # Configure logging
@@ -49,6 +54,11 @@ def load_templates(file_path):
 
 templates = load_templates("prompt_templates.yaml")
 
+# Reciprocal Rank Fusion: score(d) = sum over query result lists of 1 / (RRF_K + rank of d)
+RRF_K = 60
+# default number of fused documents passed on to grading / generation
+FUSION_TOP_N = 10
+
 
 class GraphState(TypedDict):
     """Represents the state of our graph.
@@ -88,7 +98,7 @@ def decide_to_generate_queries(state):
         return "generate_queries_not_enabled"
 
 
-def generate_queries(state):
+async def generate_queries(state):
     """Generate a variety of queries (RAG-Fusion).
 
     Args:
@@ -103,13 +113,11 @@ def generate_queries(state):
     n_queries = state_dict["n_queries"]
     settings = state_dict["settings"]
 
-    llm = ChatBedrock(
+    llm = get_chat_model(
         model_id="anthropic.claude-3-haiku-20240307-v1:0",
         region_name=settings["aws_region"],
-        model_kwargs={
-            "temperature": 0,
-            "max_tokens": 512,
-        }
+        temperature=0,
+        max_tokens=512,
     )
 
     output_format = ""
@@ -124,7 +132,7 @@ def generate_queries(state):
     prompt = ChatPromptTemplate.from_template(prompt_template)
 
     chain = prompt | llm | StrOutputParser() | (lambda x: x.split("\n"))
-    queries = chain.invoke({"question": question})
+    queries = await call_with_retry("bedrock", chain.ainvoke, {"question": question})
     queries = [query.replace('"', '') for query in queries]
     queries = [query for query in queries if re.match(r'^\d+:[^:]+$', query)]  # 数字:文字列の項目のみ抽出
     queries = [f"0: {question}"] + queries
@@ -136,9 +144,46 @@ def generate_queries(state):
     return {"keys": state_dict}
 
 
-def retrieve(state):
+def text_hash(text):
+    """Hash of a text with Unicode and whitespace differences normalized away."""
+    text = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class RankFusion(object):
+    """Accumulates RRF scores over query result lists, deduplicated by text_hash."""
+
+    def __init__(self, k=RRF_K):
+        self.k = k
+        self.scores = {}
+        self.documents = {}
+        # (query index, rank) of the earliest occurrence in query order, which breaks score
+        # ties and picks the document kept for duplicates, whatever order the lists arrive in
+        self.first_seen = {}
+
+    def add(self, query_index, documents):
+        for rank, document in enumerate(documents, start=1):
+            key = text_hash(document.metadata["excerpt"])
+            self.scores[key] = self.scores.get(key, 0.0) + 1.0 / (self.k + rank)
+            if key not in self.first_seen or (query_index, rank) < self.first_seen[key]:
+                self.first_seen[key] = (query_index, rank)
+                self.documents[key] = document
+
+    def top(self, n):
+        """Keys of the n best documents, by RRF score."""
+        return sorted(self.scores, key=lambda key: (-self.scores[key], self.first_seen[key]))[:n]
+
+
+async def retrieve(state):
     """Retrieve documents
 
+    The queries are sent to Kendra concurrently and their result lists are fused with
+    Reciprocal Rank Fusion, deduplicated by normalized text and cut to the top N
+    (state "fusion_top_n", default FUSION_TOP_N). With grade_documents enabled, grading
+    starts as each query's results arrive, for that list's top N documents, memoized per
+    page content; after fusion the grades of the fused top N are selected (any fused
+    document not graded yet is sent then) and the grades no longer needed are cancelled.
+
     Args:
         state (dict): The current graph state
 
@@ -149,43 +194,63 @@ def retrieve(state):
     state_dict = state["keys"]
     question = state_dict["question"]
     settings = state_dict["settings"]
+    top_n = state_dict.get("fusion_top_n", FUSION_TOP_N)
 
-    retriever = AmazonKendraRetriever(
+    retriever = get_kendra_retriever(
         index_id=settings["kendra_index_id"],
         region_name=settings["aws_region"],
-        attribute_filter={"EqualsTo": {"Key": "_language_code", "Value": {"StringValue": "ja"}}},
         top_k=10,
     )
 
-    documents = []
-    if "queries" in state_dict:
-        # with query expansion
-        queries = state_dict["queries"]
-
-        async def retrieve_documents(retriever, queries):
-            async def async_invoke(query):
-                return await retriever.ainvoke(query)
-            tasks = [async_invoke(query) for query in queries]
-            results = await asyncio.gather(*tasks)
-
-            unique_excerpts = set()
-            unique_documents = []
-            for result in results:
-                for document in result:
-                    excerpt = document.metadata["excerpt"]
-                    if excerpt not in unique_excerpts:
-                        unique_excerpts.add(excerpt)
-                        unique_documents.append(document)
-            return unique_documents
-
-        documents = asyncio.run(retrieve_documents(retriever, queries))
-    else:
-        # without query expansion
-        documents = retriever.invoke(question)
-
+    # with query expansion, every query; otherwise the original question
+    queries = state_dict.get("queries", [question])
+    grading = state_dict["grade_documents_enabled"] == "Yes"
+    if grading:
+        chain = grading_chain(settings)
+
+    async def search(i, query):
+        key = (settings["aws_region"], settings["kendra_index_id"], query)
+        result = retrieval_cache.get(key)
+        if result is None:
+            result = await call_with_retry("kendra", retriever.ainvoke, query)
+            retrieval_cache.set(key, result)
+        return i, result
+
+    # grading tasks per page content (the question is the same for the whole run)
+    grades = {}
+
+    def grade(document):
+        if document.page_content not in grades:
+            grades[document.page_content] = asyncio.ensure_future(grade_document(chain, question, document))
+
+    searches = [asyncio.ensure_future(search(i, query)) for i, query in enumerate(queries)]
+    fusion = RankFusion()
+    try:
+        for search_done in asyncio.as_completed(searches):
+            i, result = await search_done
+            fusion.add(i, result)
+            if grading:
+                for document in result[:top_n]:
+                    grade(document)
+    except Exception:
+        for task in searches + list(grades.values()):
+            task.cancel()
+        raise
+
+    documents = [fusion.documents[key] for key in fusion.top(top_n)]
     logger.debug(documents)
 
     state_dict["documents"] = documents
+    if grading:
+        for document in documents:
+            grade(document)
+        needed = {document.page_content for document in documents}
+        for content, task in grades.items():
+            if content not in needed:
+                task.cancel()
+                # a grade that already failed is not awaited by grade_documents
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        state_dict["document_grades"] = [grades[document.page_content] for document in documents]
     return {"keys": state_dict}
 
 
@@ -213,7 +278,7 @@ def decide_to_grade_documents(state):
         return "grade_documents_not_enabled"
 
 
-def generate(state):
+async def generate(state):
     """Generate documents
 
     Args:
@@ -228,13 +293,11 @@ def generate(state):
     documents = state_dict["documents"]
     settings = state_dict["settings"]
 
-    llm = ChatBedrock(
+    llm = get_chat_model(
         model_id=settings["generator_model_id"],
         region_name=settings["aws_region"],
-        model_kwargs={
-            "temperature": 0,
-            "max_tokens": 1024,
-        }
+        temperature=0,
+        max_tokens=1024,
     )
 
     prompt = ChatPromptTemplate(
@@ -251,7 +314,7 @@ def generate(state):
 
     rag_chain = prompt | llm | StrOutputParser()
 
-    output = rag_chain.invoke({"context": documents, "question": question})
+    output = await call_with_retry("bedrock", rag_chain.ainvoke, {"context": documents, "question": question})
     generation = re.search(r'<answer>(.*?)</answer>', output, re.DOTALL).group(1)
 
     state_dict["generation"] = generation
@@ -259,21 +322,8 @@ def generate(state):
     return {"keys": state_dict}
 
 
-def grade_documents(state):
-    """Determines whether the retrieved documents are relevant to the question.
-
-    Args:
-        state (dict): The current graph state
-
-    Returns:
-        state (dict): Updates documents key with relevant documents
-    """
-
-    logger.debug("---CHECK RELEVANCE---")
-    state_dict = state["keys"]
-    question = state_dict["question"]
-    documents = state_dict["documents"]
-    settings = state_dict["settings"]
+def grading_chain(settings):
+    """Build the chain that grades one document's relevance to the question."""
 
     # Data model
     class grade(BaseModel):
@@ -281,13 +331,11 @@ def grade_documents(state):
         binary_score: str = Field(description="Relevance score 'yes' or 'no'")
 
     # LLM
-    llm = ChatBedrock(
+    llm = get_chat_model(
         model_id="anthropic.claude-3-haiku-20240307-v1:0",
         region_name=settings["aws_region"],
-        model_kwargs={
-            "temperature": 0,
-            "max_tokens": 128,
-        }
+        temperature=0,
+        max_tokens=128,
     )
 
     parser = PydanticOutputParser(pydantic_object=grade)
@@ -298,24 +346,50 @@ def grade_documents(state):
         partial_variables={"format_instructions": parser.get_format_instructions()},
     )
 
-    chain = prompt | llm | parser
+    return prompt | llm | parser
+
+
+async def grade_document(chain, question, doc):
+    """Return whether a document is relevant to the question, memoized per grading prompt inputs."""
+    # exactly what goes into the prompt: the question as asked and the full page content
+    # (title and excerpt), so a memoized grade is always the one the model would give
+    key = (question, doc.page_content)
+    relevant = grade_cache.get(key)
+    if relevant is None:
+        score = await call_with_retry("bedrock", chain.ainvoke, {"question": question, "context": doc.page_content})
+        relevant = score.binary_score == "yes"
+        grade_cache.set(key, relevant)
+    if relevant:
+        logger.debug("---GRADE: DOCUMENT RELEVANT---")
+    else:
+        logger.debug("---GRADE: DOCUMENT NOT RELEVANT---")
+    return relevant
+
 
-    async def filter_documents(documents, question, chain):
-        async def async_invoke(doc):
-            score = await chain.ainvoke({"question": question, "context": doc.page_content})
-            if score.binary_score == "yes":
-                logger.debug("---GRADE: DOCUMENT RELEVANT---")
-                return doc
-            else:
-                logger.debug("---GRADE: DOCUMENT NOT RELEVANT---")
-                return None
+async def grade_documents(state):
+    """Determines whether the retrieved documents are relevant to the question.
 
-        tasks = [async_invoke(doc) for doc in documents]
-        results = await asyncio.gather(*tasks)
-        filtered_docs = [doc for doc in results if doc is not None]
-        return filtered_docs
+    Args:
+        state (dict): The current graph state
 
-    filtered_docs = asyncio.run(filter_documents(documents, question, chain))
+    Returns:
+        state (dict): Updates documents key with relevant documents
+    """
+
+    logger.debug("---CHECK RELEVANCE---")
+    state_dict = state["keys"]
+    question = state_dict["question"]
+    documents = state_dict["documents"]
+    settings = state_dict["settings"]
+
+    # grading normally already started in retrieve
+    grades = state_dict.pop("document_grades", None)
+    if grades is None:
+        chain = grading_chain(settings)
+        grades = [grade_document(chain, question, doc) for doc in documents]
+
+    results = await asyncio.gather(*grades)
+    filtered_docs = [doc for doc, relevant in zip(documents, results) if relevant]
     logger.debug(len(filtered_docs))
     logger.debug(filtered_docs)
 
@@ -327,6 +401,12 @@ def grade_documents(state):
     return {"keys": state_dict}
 
 
+@lru_cache(maxsize=None)
+def get_graph():
+    """Return the compiled graph, built once per process."""
+    return build_graph()
+
+
 def build_graph():
     workflow = StateGraph(GraphState)
 
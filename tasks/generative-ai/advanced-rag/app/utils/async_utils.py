@@ -0,0 +1,100 @@
+import asyncio
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+# One event loop for the whole process, running in a daemon thread. The graph runs
+# on it via run() / iterate(), so the fan-outs to Kendra and Bedrock never create
+# and tear down a loop per call.
+_loop = None
+_loop_lock = threading.Lock()
+
+# Maximum number of in-flight calls per backend
+MAX_CONCURRENCY = {
+    "kendra": 5,
+    "bedrock": 8,
+}
+_semaphores = {}
+
+THROTTLING_ERRORS = (
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+)
+
+
+def get_loop():
+    """Return the shared event loop, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run(coro):
+    """Run a coroutine on the shared loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iterate(async_iterator):
+    """
+    Iterate an async iterator on the shared loop from synchronous code. Closing
+    the generator early (e.g. when Streamlit stops the script mid-stream) also
+    closes the async iterator, so the graph run is not left suspended on the loop.
+    """
+    try:
+        while True:
+            try:
+                yield run(async_iterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(async_iterator, "aclose", None)
+        if aclose is not None:
+            run(aclose())
+
+
+def _semaphore(backend):
+    # only called from coroutines on the shared loop, so no lock is needed
+    if backend not in _semaphores:
+        _semaphores[backend] = asyncio.Semaphore(MAX_CONCURRENCY[backend])
+    return _semaphores[backend]
+
+
+def is_throttling(e):
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+    # langchain_aws re-raises Bedrock errors as ValueError with the original message
+    return any(code in str(e) for code in THROTTLING_ERRORS)
+
+
+async def call_with_retry(backend, fn, *args, max_attempts=5, base_delay=0.5, max_delay=8.0):
+    """ Await fn(*args) with at most MAX_CONCURRENCY[backend] calls in flight.
+
+    Throttling errors are retried with exponential backoff and full jitter; the
+    backoff is spent outside the semaphore so other calls can proceed. These are the
+    only retries: the clients from utils.clients that are called through here make a
+    single botocore attempt, so a call makes at most `max_attempts` requests.
+
+    Args:
+        backend (str): A key of MAX_CONCURRENCY.
+        fn (Callable): An async function, e.g. a runnable's ainvoke.
+        max_attempts (int): The number of attempts before the error is raised.
+        base_delay (float): The backoff ceiling in seconds for the first retry.
+        max_delay (float): The maximum backoff ceiling in seconds.
+
+    Returns:
+        The result of fn(*args).
+    """
+    for attempt in range(max_attempts):
+        async with _semaphore(backend):
+            try:
+                return await fn(*args)
+            except Exception as e:
+                if attempt == max_attempts - 1 or not is_throttling(e):
+                    raise
+        await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
@@ -0,0 +1,190 @@
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+# Answers are cached per (question, settings) with an exact-match LRU and, optionally,
+# an embedding-similarity tier for near-repeats. Kendra results are cached per query,
+# and document grades per (question, document text) as they go into the grading prompt.
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 60 * 60
+RETRIEVAL_CACHE_SIZE = 4096
+RETRIEVAL_CACHE_TTL = 60 * 60
+GRADE_CACHE_SIZE = 65536
+GRADE_CACHE_TTL = 24 * 60 * 60
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# settings that change the answer; the others only change what is displayed
+ANSWER_SETTINGS = (
+    "aws_region",
+    "kendra_index_id",
+    "generator_model_id",
+    "preretrieval_method",
+    "postretrieval_method",
+    "fusion_top_n",
+)
+
+
+def normalize_question(question):
+    """ Normalize a question for exact-match lookups.
+
+    Applies NFKC (full-width to half-width), lowercases, collapses whitespace and
+    strips trailing punctuation, so "Kendra とは？ " and "kendra とは?" match.
+
+    Args:
+        question (str): The question.
+
+    Returns:
+        str: The normalized question.
+    """
+    question = unicodedata.normalize("NFKC", question).lower()
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.rstrip("?!.。 ")
+
+
+def settings_key(settings):
+    return json.dumps({k: settings.get(k) for k in ANSWER_SETTINGS}, sort_keys=True)
+
+
+class LRUCache(object):
+    """Thread-safe LRU with a time-to-live per entry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class SemanticCache(object):
+    """
+    Embedding-similarity cache over a local in-memory vector index. A lookup returns
+    the value of the most similar entry in the same namespace when its cosine
+    similarity reaches `threshold`. Expired entries are dropped on insert, then the
+    oldest ones until at most `max_size` remain.
+    """
+
+    def __init__(self, max_size, ttl, threshold):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.vectors = None  # (entries, dim) unit vectors
+        self.namespaces = []
+        self.expires = []
+        self.values = []
+
+    def lookup(self, namespace, vector):
+        vector = self._unit(vector)
+        with self.lock:
+            if self.vectors is None or not self.values:
+                return None
+            scores = self.vectors @ vector
+            now = time.time()
+            best, best_score = None, self.threshold
+            for i in np.argsort(-scores):
+                if scores[i] < best_score:
+                    break
+                if self.namespaces[i] == namespace and self.expires[i] >= now:
+                    best = self.values[i]
+                    break
+            return best
+
+    def add(self, namespace, vector, value):
+        vector = self._unit(vector)
+        with self.lock:
+            now = time.time()
+            keep = [i for i, expires in enumerate(self.expires) if expires >= now]
+            keep = keep[max(len(keep) - self.max_size + 1, 0):]
+            if self.vectors is None or not keep:
+                self.vectors = vector[None, :]
+                self.namespaces, self.expires, self.values = [namespace], [now + self.ttl], [value]
+                return
+            self.vectors = np.vstack([self.vectors[keep], vector[None, :]])
+            self.namespaces = [self.namespaces[i] for i in keep] + [namespace]
+            self.expires = [self.expires[i] for i in keep] + [now + self.ttl]
+            self.values = [self.values[i] for i in keep] + [value]
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class AnswerCache(object):
+    """
+    Two-tier cache of final graph states: an exact-match LRU keyed by the normalized
+    question and settings, then, when `semantic` is requested, the embedding-similarity
+    tier. Both tiers store the question the answer was generated for, so a semantic hit
+    can be shown as the answer to that question. `embed` maps (text, settings) to an
+    embedding vector.
+    """
+
+    def __init__(self, embed, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                 semantic_size=SEMANTIC_CACHE_SIZE, threshold=SEMANTIC_CACHE_THRESHOLD):
+        self.embed = embed
+        self.exact = LRUCache(max_size, ttl)
+        self.semantic = SemanticCache(semantic_size, ttl, threshold)
+
+    def get(self, question, settings, semantic=False):
+        """ Look up a cached answer.
+
+        Args:
+            question (str): The question.
+            settings (dict): The app settings.
+            semantic (bool): Whether to fall back to the embedding-similarity tier.
+
+        Returns:
+            tuple: The cached value or None, the question it was generated for (None on
+            a miss), and the question embedding (None unless the semantic tier was
+            searched), to pass back to put().
+        """
+        key = (normalize_question(question), settings_key(settings))
+        entry = self.exact.get(key)
+        if entry is None and semantic:
+            vector = self.embed(key[0], settings)
+            entry = self.semantic.lookup(key[1], vector)
+        else:
+            vector = None
+        if entry is None:
+            return None, None, vector
+        cached_question, value = entry
+        return value, cached_question, vector
+
+    def put(self, question, settings, value, semantic=False, vector=None):
+        key = (normalize_question(question), settings_key(settings))
+        self.exact.set(key, (question, value))
+        if semantic:
+            if vector is None:
+                vector = self.embed(key[0], settings)
+            self.semantic.add(key[1], vector, (question, value))
+
+
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+grade_cache = LRUCache(GRADE_CACHE_SIZE, GRADE_CACHE_TTL)
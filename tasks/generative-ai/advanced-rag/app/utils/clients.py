@@ -0,0 +1,128 @@
+import threading
+
+import boto3
+from botocore.config import Config
+from langchain_aws import AmazonKendraRetriever
+from langchain_aws import BedrockEmbeddings
+from langchain_aws import ChatBedrock
+
+# Process-wide registry of AWS clients and the LangChain objects built on them.
+# boto3 clients are thread-safe, so every request (and every node of the graph)
+# shares the same clients and their pooled HTTP connections.
+_lock = threading.RLock()  # factories look up other registry entries
+_registry = {}
+
+# grade_documents calls the model once per retrieved document concurrently
+MAX_POOL_CONNECTIONS = 50
+# Botocore attempts for clients called directly. The clients behind
+# async_utils.call_with_retry make a single attempt: it retries throttling itself,
+# outside its concurrency semaphore, and botocore retries would stack under it.
+MAX_ATTEMPTS = 3
+
+
+def _get_or_create(key, factory):
+    obj = _registry.get(key)
+    if obj is None:
+        # creating clients from the default boto3 session is not thread-safe
+        with _lock:
+            obj = _registry.get(key)
+            if obj is None:
+                obj = factory()
+                _registry[key] = obj
+    return obj
+
+
+def get_boto3_client(service_name, region_name=None, max_attempts=MAX_ATTEMPTS):
+    """ Return the shared boto3 client for a service, region and retry budget.
+
+    Args:
+        service_name (str): The AWS service, e.g. "bedrock-runtime" or "kendra".
+        region_name (str): The AWS region, or None for the default region.
+        max_attempts (int): The botocore attempts per call (standard retry mode);
+            1 for clients whose calls go through call_with_retry.
+
+    Returns:
+        botocore.client.BaseClient: The shared client.
+    """
+    config = Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        retries={"total_max_attempts": max_attempts, "mode": "standard"},
+    )
+    return _get_or_create(
+        ("boto3", service_name, region_name, max_attempts),
+        lambda: boto3.client(service_name, region_name=region_name, config=config),
+    )
+
+
+def get_chat_model(model_id, region_name, temperature=0, max_tokens=1024):
+    """ Return the shared ChatBedrock for a model, region and generation settings.
+
+    Its client makes a single attempt per call; call it through call_with_retry.
+
+    Args:
+        model_id (str): The Bedrock model id.
+        region_name (str): The AWS region.
+        temperature (float): The sampling temperature.
+        max_tokens (int): The maximum number of tokens to generate.
+
+    Returns:
+        ChatBedrock: The shared chat model.
+    """
+    return _get_or_create(
+        ("bedrock", region_name, model_id, temperature, max_tokens),
+        lambda: ChatBedrock(
+            client=get_boto3_client("bedrock-runtime", region_name, max_attempts=1),
+            model_id=model_id,
+            region_name=region_name,
+            model_kwargs={
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+            },
+        ),
+    )
+
+
+def get_embeddings(model_id, region_name):
+    """ Return the shared BedrockEmbeddings for a model and region.
+
+    Args:
+        model_id (str): The Bedrock embedding model id.
+        region_name (str): The AWS region.
+
+    Returns:
+        BedrockEmbeddings: The shared embeddings model.
+    """
+    return _get_or_create(
+        ("bedrock-embeddings", region_name, model_id),
+        lambda: BedrockEmbeddings(
+            client=get_boto3_client("bedrock-runtime", region_name),
+            model_id=model_id,
+            region_name=region_name,
+        ),
+    )
+
+
+def get_kendra_retriever(index_id, region_name, top_k=10):
+    """ Return the shared AmazonKendraRetriever for an index and region.
+
+    Its client makes a single attempt per call; call it through call_with_retry.
+
+    Args:
+        index_id (str): The Kendra index id.
+        region_name (str): The AWS region.
+        top_k (int): The number of documents to retrieve per query.
+
+    Returns:
+        AmazonKendraRetriever: The shared retriever.
+    """
+    return _get_or_create(
+        ("kendra", region_name, index_id, top_k),
+        lambda: AmazonKendraRetriever(
+            client=get_boto3_client("kendra", region_name, max_attempts=1),
+            index_id=index_id,
+            region_name=region_name,
+            attribute_filter={"EqualsTo": {"Key": "_language_code", "Value": {"StringValue": "ja"}}},
+            top_k=top_k,
+        ),
+    )
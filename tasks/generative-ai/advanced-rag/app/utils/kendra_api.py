@@ -1,8 +1,8 @@
-import boto3
+from utils.clients import get_boto3_client
 
 def search_kendra(query, settings):
     # Amazon Kendraを使用して検索を実行する
-    kendra = boto3.client("kendra", region_name=settings["aws_region"])
+    kendra = get_boto3_client("kendra", settings["aws_region"])
     response = kendra.query(
         QueryText=query,
         IndexId=settings["kendra_index_id"],
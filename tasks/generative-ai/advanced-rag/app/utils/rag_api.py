@@ -1,12 +1,25 @@
 import re
+import logging
+from contextlib import closing
 import streamlit as st
 from langgraph.graph import END, StateGraph
 from utils import advanced_rag
-from utils.advanced_rag import build_graph
+from utils.advanced_rag import get_graph
+from utils.async_utils import iterate
+from utils.cache import AnswerCache
+from utils.clients import get_embeddings
 from utils.s3_utils import generate_presigned_url_from_s3_uri
 
 ja2en = {"なし": None, "クエリ拡張": "generate_queries", "検索結果の関連度評価": "grade_documents"}
 
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+logger = logging.getLogger(__name__)
+
+answer_cache = AnswerCache(
+    lambda text, settings: get_embeddings(EMBEDDING_MODEL_ID, settings["aws_region"]).embed_query(text)
+)
+
 def generate_rag_answer(query, settings):
     preretrieval_method = ja2en[settings["preretrieval_method"]]
     postretrieval_method = ja2en[settings["postretrieval_method"]]
@@ -15,6 +28,7 @@ def generate_rag_answer(query, settings):
         "question": query,
         "n_queries": -1,
         "grade_documents_enabled": "No",
+        "fusion_top_n": settings.get("fusion_top_n", advanced_rag.FUSION_TOP_N),
         "settings": settings
     }}
     if preretrieval_method == "generate_queries":
@@ -22,30 +36,54 @@ def generate_rag_answer(query, settings):
     if postretrieval_method == "grade_documents":
         inputs["keys"]["grade_documents_enabled"] = "Yes"
 
-    app = build_graph()
+    # 同じ質問 (semantic_cache が有効なら類似の質問) の回答はキャッシュから返す
+    semantic = settings.get("semantic_cache", False)
+    vector = None
+    try:
+        cached, cached_question, vector = answer_cache.get(query, settings, semantic=semantic)
+    except Exception as e:
+        logger.warning(f"Answer cache lookup failed: {e}")
+        cached = None
+    if cached is not None:
+        if cached_question != query:
+            # 類似の質問の回答を返すときは、どの質問の回答かを表示する
+            st.caption(f"キャッシュ済みの質問「{cached_question}」への回答です")
+        documents = cached["keys"]["documents"]
+        with st.popover(f"{len(documents)}件のチャンク (キャッシュ)"):
+            show_documents(documents)
+        return cached
+
+    app = get_graph()
 
     with st.spinner("Generating answer..."):
-        for output in app.stream(inputs):
-            for key, value in output.items():
-                if key == "generate_queries":
-                    columns = st.columns(value["keys"]["n_queries"] + 1)
-                    for i, column in enumerate(columns):
-                        with column:
-                            st.markdown(f"""
+        # the async nodes run on the shared event loop; closing() stops the graph run when
+        # Streamlit interrupts the script mid-stream
+        with closing(iterate(app.astream(inputs))) as outputs:
+            for output in outputs:
+                for key, value in output.items():
+                    if key == "generate_queries":
+                        columns = st.columns(value["keys"]["n_queries"] + 1)
+                        for i, column in enumerate(columns):
+                            with column:
+                                st.markdown(f"""
 <div style="background-color:#f1f1f1; padding:0px 10px; border-radius:12px; font-size:12px;">
 {value["keys"]["queries"][i]}
 </div>
 """, unsafe_allow_html=True)
-                    st.markdown("")
-                elif key == "retrieve":
-                    documents = value["keys"]["documents"]
-                    with st.popover(f"{len(documents)}件のユニークなチャンク"):
-                        show_documents(documents)
-                elif key == "grade_documents":
-                    documents = value["keys"]["documents"]
-                    with st.popover(f"{len(documents)}件の関連度の高いチャンク"):
-                        show_documents(documents)
-    
+                        st.markdown("")
+                    elif key == "retrieve":
+                        documents = value["keys"]["documents"]
+                        with st.popover(f"{len(documents)}件のユニークなチャンク"):
+                            show_documents(documents)
+                    elif key == "grade_documents":
+                        documents = value["keys"]["documents"]
+                        with st.popover(f"{len(documents)}件の関連度の高いチャンク"):
+                            show_documents(documents)
+
+    try:
+        answer_cache.put(query, settings, value, semantic=semantic, vector=vector)
+    except Exception as e:
+        logger.warning(f"Answer cache update failed: {e}")
     return value
     #st.write(value["keys"]["generation"])
     #for chunk in value["keys"]["generation"]:
@@ -1,9 +1,10 @@
-import boto3
 from botocore.exceptions import ClientError
 
+from utils.clients import get_boto3_client
+
 def generate_presigned_url(bucket_name, object_name, expiration=300):
     """Generate a presigned URL to share an S3 object"""
-    s3_client = boto3.client('s3')
+    s3_client = get_boto3_client('s3')
     try:
         response = s3_client.generate_presigned_url(
             'get_object',
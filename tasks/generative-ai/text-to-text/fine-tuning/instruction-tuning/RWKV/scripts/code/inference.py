@@ -1,22 +1,29 @@
-import os, json, torch
+import os, json, time, types, torch
 from rwkv.model import RWKV
 from rwkv.utils import PIPELINE, PIPELINE_ARGS
+from src.state_cache import StateCache
+from src.sampler import sample_logits, make_generator
+from src.lora_merge import load_state_dict, merge_lora_weights, merged_model_path
 os.environ['RWKV_JIT_ON'] = '1'
 os.environ["RWKV_CUDA_ON"] = '0'
 
+PROMPT_HEADER_INPUT = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+# Instruction:
+"""
+
+PROMPT_HEADER_NO_INPUT = """Below is an instruction that describes a task. Write a response that appropriately completes the request.
+# Instruction:
+"""
+
 def generate_prompt(instruction, input):
     if input != "":
-        return f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-# Instruction:
-{instruction}
+        return PROMPT_HEADER_INPUT + f"""{instruction}
 # Input:
 {input}
 # Response:
 """
     else:
-        return f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
-# Instruction:
-{instruction}
+        return PROMPT_HEADER_NO_INPUT + f"""{instruction}
 # Response:
 """
     
@@ -27,49 +34,12 @@ def merge_lora(
     lora: str = "",
     output: str = "",
 ):
-    # Original: https://github.com/Blealtan/RWKV-LM-LoRA/blob/main/RWKV-v4neo/merge_lora.py
-    from collections import OrderedDict
-    import sys
-    from typing import Dict
-    import typing
-    
     device = 'cuda' if use_gpu else 'cpu'
-
-    with torch.no_grad():
-        w: Dict[str, torch.Tensor] = torch.load(base_model, map_location=device)
-        # merge LoRA-only slim checkpoint into the main weights
-        w_lora: Dict[str, torch.Tensor] = torch.load(lora, map_location=device)
-        for k in w_lora.keys():
-            w[k] = w_lora[k]
-        output_w: typing.OrderedDict[str, torch.Tensor] = OrderedDict()
-        # merge LoRA weights
-        keys = list(w.keys())
-        for k in keys:
-            if k.endswith('.weight'):
-                prefix = k[:-len('.weight')]
-                lora_A = prefix + '.lora_A'
-                lora_B = prefix + '.lora_B'
-                if lora_A in keys:
-                    assert lora_B in keys
-                    print(f'merging {lora_A} and {lora_B} into {k}')
-                    assert w[lora_B].shape[1] == w[lora_A].shape[0]
-                    lora_r = w[lora_B].shape[1]
-                    w[k] = w[k].to(device=device)
-                    w[lora_A] = w[lora_A].to(device=device)
-                    w[lora_B] = w[lora_B].to(device=device)
-                    w[k] += w[lora_B] @ w[lora_A] * (lora_alpha / lora_r)
-                    output_w[k] = w[k].to(device='cpu', copy=True)
-                    del w[k]
-                    del w[lora_A]
-                    del w[lora_B]
-                    continue
-
-            if 'lora' not in k:
-                print(f'retaining {k}')
-                output_w[k] = w[k].clone()
-                del w[k]
-
-        torch.save(output_w, output)
+    w = merge_lora_weights(
+        load_state_dict(base_model), load_state_dict(lora), lora_alpha,
+        device=device, out_device='cpu',
+    )
+    torch.save(w, output)
 
 def load_model(
     model_path: str = "",
@@ -77,7 +47,10 @@ def load_model(
     tokenizer_path: str = "",
     strategy: str = "",
     lora: str = "",
-    lora_alpha: int = 32
+    lora_alpha: int = 32,
+    merged_cache_dir: str = "/tmp/rwkv_merged",
+    state_cache_mb: int = 512,
+    state_cache_dir: str = "",
 ):
     print(model_path, model_url, tokenizer_path, strategy)
     
@@ -87,24 +60,85 @@ def load_model(
         print(f"Downloading model from {model_url} this may take a while")
         urllib.request.urlretrieve(model_url, model_path)
         
-    # Merge LoRA weights if exist
+    # Merge LoRA weights if exist (cached by base model + adapter + alpha)
     if lora:
         print("Merging LoRA weights...")
-        output_path = "/tmp/merged.pth"
-        merge_lora(
-            use_gpu = torch.cuda.is_available(),
+        model_path = merged_model_path(
+            model_path,
+            lora,
             lora_alpha = lora_alpha,
-            base_model = model_path,
-            lora = lora,
-            output = output_path,
+            cache_dir = merged_cache_dir,
+            device = 'cuda' if torch.cuda.is_available() else 'cpu',
         )
-        model_path = output_path
     
     print("Loading Model...")
     model = RWKV(model=model_path, strategy=strategy)
     pipeline = PIPELINE(model, tokenizer_path)
+    state_cache = StateCache(
+        max_bytes = state_cache_mb * 1024 * 1024,
+        spill_dir = state_cache_dir or None,
+    )
     
-    return pipeline
+    return pipeline, state_cache
+
+
+def prefill(pipeline, state_cache, tokens, checkpoints=(), chunk_len=256):
+    # resume from the longest cached prefix of the prompt; the state at each checkpoint
+    # (prefix length) and at len(tokens)-1 is cached for the next request
+    n, state = state_cache.lookup(tokens[:-1])
+    ends = sorted(set(c for c in checkpoints if n < c < len(tokens)) | {len(tokens) - 1, len(tokens)})
+    for end in ends:
+        while n < end:
+            out, state = pipeline.model.forward(tokens[n:min(n + chunk_len, end)], state)
+            n = min(n + chunk_len, end)
+        if end < len(tokens):
+            state_cache.put(tokens[:end], state)
+    return out, state
+
+
+def generate_stream(pipeline, state_cache, prompt, header="", token_count=100, args=PIPELINE_ARGS(), max_time=None, seed=None):
+    # same decoding loop as PIPELINE.generate, but the prompt is prefilled through the state cache
+    # and text is yielded as soon as it decodes. Decoding stops after max_time seconds (the
+    # request's own time budget, prefill included) or when the consumer closes the generator
+    deadline = time.monotonic() + max_time if max_time is not None else None
+    tokens = pipeline.encode(prompt)
+    checkpoints = []
+    if header:
+        header_tokens = pipeline.encode(header)
+        if tokens[:len(header_tokens)] == header_tokens:
+            checkpoints.append(len(header_tokens))
+    out, state = prefill(pipeline, state_cache, tokens, checkpoints, chunk_len=args.chunk_len)
+    generator = make_generator(seed, out.device) if seed is not None else None
+
+    all_tokens = []
+    out_last = 0
+    occurrence = {}
+    for i in range(token_count):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        if i > 0:
+            out, state = pipeline.model.forward([token], state)
+        for n in args.token_ban:
+            out[n] = -float('inf')
+        for n in occurrence:
+            out[n] -= (args.alpha_presence + occurrence[n] * args.alpha_frequency)
+
+        token = sample_logits(out, temperature=args.temperature, top_p=args.top_p, top_k=args.top_k, generator=generator)
+        if token in args.token_stop:
+            break
+        all_tokens += [token]
+        for n in occurrence:
+            occurrence[n] *= getattr(args, 'alpha_decay', 1.0)
+        occurrence[token] = occurrence.get(token, 0) + 1
+
+        tmp = pipeline.decode(all_tokens[out_last:])
+        if '\ufffd' not in tmp: # is valid utf-8 string?
+            out_last = i + 1
+            yield tmp
+
+
+def generate(pipeline, state_cache, prompt, header="", token_count=100, args=PIPELINE_ARGS(), max_time=None, seed=None):
+    return ''.join(generate_stream(pipeline, state_cache, prompt, header=header, token_count=token_count, args=args, max_time=max_time, seed=seed))
     
     
 def evaluate(
@@ -116,9 +150,12 @@ def evaluate(
     top_k=40,
     num_beams=4,
     token_count=200,
+    stream=False,
+    max_time=None,
+    seed=None,
     **kwargs,
 ):
-    pipeline = model_objects
+    pipeline, state_cache = model_objects
     
     args = PIPELINE_ARGS(
         temperature = temperature,
@@ -133,8 +170,12 @@ def evaluate(
     ) 
     
     prompt = generate_prompt(instruction, input)
+    header = PROMPT_HEADER_INPUT if input != "" else PROMPT_HEADER_NO_INPUT
+    
+    if stream:
+        return generate_stream(pipeline, state_cache, prompt, header=header, token_count=token_count, args=args, max_time=max_time, seed=seed)
     
-    result = pipeline.generate(prompt, token_count=token_count, args=args)
+    result = generate(pipeline, state_cache, prompt, header=header, token_count=token_count, args=args, max_time=max_time, seed=seed)
     
     return result
 
@@ -171,3 +212,34 @@ def predict_fn(
     except Exception as e:
         print("Inference error: ", e)
         
+
+
+def output_fn(prediction, accept, context=None):
+    from sagemaker_inference import encoder
+
+    if not isinstance(prediction, types.GeneratorType):
+        return encoder.encode(prediction, accept)
+
+    # {"stream": true}: send every decoded piece as an intermediate response, which TorchServe
+    # writes to the client with chunked transfer encoding. TorchServe does not tell the handler
+    # when the client goes away, so a stream is bounded by its token_count / max_time only
+    try:
+        from ts.protocol.otf_message_handler import send_intermediate_predict_response
+    except ImportError:
+        send_intermediate_predict_response = None
+    if context is None or send_intermediate_predict_response is None:
+        return encoder.encode("".join(prediction), accept)
+
+    try:
+        for chunk in prediction:
+            send_intermediate_predict_response(
+                [encoder.encode(chunk, accept)],
+                context.request_ids,
+                "Intermediate Prediction success",
+                200,
+                context,
+            )
+    finally:
+        # stops the decode loop if sending failed part way
+        prediction.close()
+    return encoder.encode("", accept)
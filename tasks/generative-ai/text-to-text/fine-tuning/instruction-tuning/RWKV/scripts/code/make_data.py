@@ -0,0 +1,144 @@
+########################################################################################################
+# Build a binidx (.bin/.idx) training set from JSONL without loading the corpus into memory
+########################################################################################################
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    ########################################################################################################
+    #
+    # example: tokenize an instruction dataset (instruction / input / output or Dolly's context / response)
+    #
+    # python make_data.py --input ../../data/databricks-dolly-15k.jsonl --tokenizer ../../data/20B_tokenizer.json \
+    # --output ../../data/dolly --workers 8
+    #
+    # then train with --data_file ../../data/dolly --data_type binidx --vocab_size 50277
+    #
+    # example: continue an interrupted build (same --input list), or merge shards built separately
+    #
+    # python make_data.py --input a.jsonl b.jsonl --tokenizer 20B_tokenizer.json --output data/ab --resume
+    # python make_data.py --merge data/shard0 data/shard1 --output data/all
+    #
+    ########################################################################################################
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--input", nargs="*", default=[], type=str)  # JSONL files, read in order
+    parser.add_argument("--tokenizer", default="", type=str)  # tokenizers json, e.g. 20B_tokenizer.json
+    parser.add_argument("--output", default="", type=str)  # output prefix, writes <output>.bin / <output>.idx
+    parser.add_argument("--merge", nargs="*", default=[], type=str)  # existing binidx prefixes to concatenate
+    parser.add_argument("--workers", default=4, type=int)  # tokenizer processes
+    parser.add_argument("--chunksize", default=256, type=int)  # lines sent to a worker at a time
+    parser.add_argument("--eos", default=0, type=int)  # appended to every document (0 = <|endoftext|> in 20B_tokenizer)
+    parser.add_argument("--checkpoint_every", default=100000, type=int)  # documents between resumable checkpoints
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--qa_spans", action="store_true")  # also write <output>.qa_spans.npy for --my_qa_mask 1
+
+    args = parser.parse_args()
+
+    ########################################################################################################
+
+import os, sys, json, time
+import itertools
+from multiprocessing import Pool
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from src.binidx import MMapIndexedDataset, MMapIndexedDatasetBuilder
+from src.qa_mask import save_qa_spans
+
+def generate_prompt(instruction, input, output):
+    # same format as the RWKV_Finetune notebook; <|endoftext|> is appended as the --eos token
+    if input != "":
+        return f"""Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
+# Instruction:
+{instruction}
+# Input:
+{input}
+# Response:
+{output}
+"""
+    else:
+        return f"""Below is an instruction that describes a task. Write a response that appropriately completes the request.
+# Instruction:
+{instruction}
+# Response:
+{output}
+"""
+
+def record_to_text(record):
+    if "text" in record:
+        return record["text"]
+    return generate_prompt(
+        record["instruction"].strip(),
+        record.get("input", record.get("context", "")).strip(),
+        record.get("output", record.get("response", "")).strip(),
+    )
+
+_tokenizer = None
+
+def _init_worker(tokenizer_file):
+    global _tokenizer
+    from tokenizers import Tokenizer
+    _tokenizer = Tokenizer.from_file(tokenizer_file)
+
+def _encode(line):
+    line = line.strip()
+    if not line:
+        return None
+    return _tokenizer.encode(record_to_text(json.loads(line))).ids
+
+def read_lines(files):
+    for file in files:
+        with open(file, "r", encoding="utf-8") as f:
+            for line in f:
+                yield line
+
+def build(files, tokenizer_file, output, workers=4, chunksize=256, eos=0, checkpoint_every=100000, resume=False):
+    from tokenizers import Tokenizer
+    vocab_size = Tokenizer.from_file(tokenizer_file).get_vocab_size()
+    dtype = np.uint16 if vocab_size < 65500 else np.int32
+
+    builder = MMapIndexedDatasetBuilder(output, dtype=dtype, resume=resume)
+    lines_done = builder.meta.get("lines", 0)
+    if lines_done > 0:
+        print(f"Resuming after {lines_done} lines ({len(builder)} documents)")
+
+    t0 = time.time()
+    lines = itertools.islice(read_lines(files), lines_done, None)
+    with Pool(workers, initializer=_init_worker, initargs=(tokenizer_file,)) as pool:
+        for ids in pool.imap(_encode, lines, chunksize=chunksize):
+            lines_done += 1
+            if ids is not None:
+                builder.add_item(ids + [eos])
+                builder.end_document()
+            if lines_done % checkpoint_every == 0:
+                builder.meta["lines"] = lines_done
+                builder.checkpoint()
+                print(f"{lines_done} lines, {len(builder)} documents, {time.time() - t0:.1f}s", flush=True)
+    builder.finalize()
+    return output
+
+def merge(prefixes, output):
+    dtype = MMapIndexedDataset.Index(prefixes[0] + ".idx").dtype
+    builder = MMapIndexedDatasetBuilder(output, dtype=dtype)
+    for prefix in prefixes:
+        print(f"Merging {prefix}")
+        builder.merge_file_(prefix)
+    builder.finalize()
+    return output
+
+if __name__ == "__main__":
+    if args.merge:
+        merge(args.merge, args.output)
+    else:
+        build(
+            args.input, args.tokenizer, args.output,
+            workers=args.workers, chunksize=args.chunksize, eos=args.eos,
+            checkpoint_every=args.checkpoint_every, resume=args.resume,
+        )
+    data = MMapIndexedDataset(args.output)
+    print(f"Done: {args.output}.bin / .idx, {len(data)} documents, {len(data._bin_buffer) // data._index._dtype_size} tokens")
+    if args.qa_spans:
+        tokens = np.frombuffer(data._bin_buffer, dtype=data._index.dtype)
+        spans = save_qa_spans(args.output, tokens)
+        print(f"Wrote {len(spans)} QA mask spans")
@@ -0,0 +1,59 @@
+########################################################################################################
+# Checkpoint surgery: grow (or shrink) an RWKV checkpoint to a new n_embd / dim_ffn / vocab_size
+########################################################################################################
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    ########################################################################################################
+    #
+    # example: take the shapes (and fresh init for new keys) from a stage-1 rwkv-init.pth of the bigger model
+    #
+    # python resize_model.py --load_model rwkv-small.pth --target_model out/rwkv-init.pth --output rwkv-grown.pth
+    #
+    # example: no target model, just rescale the matching axes of every tensor
+    #
+    # python resize_model.py --load_model RWKV-4-Pile-169M.pth --n_embd 1024 --output rwkv-1024.pth
+    #
+    ########################################################################################################
+
+    parser = ArgumentParser()
+
+    parser.add_argument("--load_model", default="", type=str)  # source checkpoint
+    parser.add_argument("--target_model", default="", type=str)  # checkpoint whose keys / shapes / dtypes to produce
+    parser.add_argument("--output", default="", type=str)
+    parser.add_argument("--n_embd", default=0, type=int)  # without --target_model: new sizes (0 = keep)
+    parser.add_argument("--dim_ffn", default=0, type=int)  # 0 = 4 * n_embd when n_embd changes
+    parser.add_argument("--vocab_size", default=0, type=int)
+    parser.add_argument("--device", default="cuda", type=str)  # falls back to cpu without CUDA
+
+    args = parser.parse_args()
+
+    ########################################################################################################
+
+import os, sys
+import torch
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from src.lora_merge import load_state_dict
+from src.resize import resize_state_dict
+
+def target_shapes(w, n_embd=0, dim_ffn=0, vocab_size=0):
+    # empty tensors in the new shapes, mapping each axis that equals the old n_embd / dim_ffn / vocab_size
+    old_vocab, old_embd = w['emb.weight'].shape
+    old_ffn = w['blocks.0.ffn.key.weight'].shape[0]
+    n_embd = n_embd or old_embd
+    dim_ffn = dim_ffn or (old_ffn if n_embd == old_embd else n_embd * 4)
+    sizes = {old_vocab: vocab_size or old_vocab, old_embd: n_embd, old_ffn: dim_ffn}
+    assert len(sizes) == 3, "n_embd, dim_ffn and vocab_size of the source model must differ"
+    return {k: torch.empty([sizes.get(d, d) for d in t.shape], dtype=t.dtype) for k, t in w.items()}
+
+if __name__ == "__main__":
+    device = args.device if args.device == "cpu" or torch.cuda.is_available() else "cpu"
+    w = load_state_dict(args.load_model)
+    if args.target_model:
+        target = load_state_dict(args.target_model)
+    else:
+        target = target_shapes(w, args.n_embd, args.dim_ffn, args.vocab_size)
+    out = resize_state_dict(w, target, device=device)
+    print(f"Save to {args.output}...")
+    torch.save(out, args.output)
@@ -4,6 +4,8 @@ import torch
 import numpy as np
 import shutil
 import struct
+import json
+from array import array
 from functools import lru_cache
 from itertools import accumulate
 
@@ -45,6 +47,15 @@ def index_file_path(prefix_path):
 def data_file_path(prefix_path):
     return prefix_path + ".bin"
 
+def progress_file_path(prefix_path):
+    return prefix_path + ".progress.json"
+
+def _sizes_tmp_path(prefix_path):
+    return prefix_path + ".sizes.tmp"
+
+def _doc_idx_tmp_path(prefix_path):
+    return prefix_path + ".doc_idx.tmp"
+
 class MMapIndexedDataset(torch.utils.data.Dataset):
     class Index(object):
         _HDR_MAGIC = b"MMIDIDX\x00\x00"
@@ -68,12 +79,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    np.cumsum(np.asarray(sizes, dtype=np.int64)[:-1] * dtype_size, out=pointers[1:])
 
                     return pointers
 
@@ -244,6 +251,20 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         )
         return np_array
 
+    def get_batch(self, offsets, length, idx=0):
+        """Retrieves windows [offset, offset + length) of the token stream starting
+        at item idx, for every offset, with a single fancy-index on the memory map.
+
+        Returns a (len(offsets), length) int64 tensor allocated in shared memory,
+        so DataLoader workers hand it to the main process without another copy.
+        """
+        ptr, size = self._index[idx]
+        np_array = np.frombuffer(self._bin_buffer, dtype=self._index.dtype, offset=ptr)
+        windows = np.lib.stride_tricks.sliding_window_view(np_array, length)
+        out = torch.empty((len(offsets), length), dtype=torch.long).share_memory_()
+        out.numpy()[...] = windows[np.asarray(offsets, dtype=np.int64)]
+        return out
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -267,3 +288,107 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         return os.path.exists(index_file_path(path)) and os.path.exists(
             data_file_path(path)
         )
+
+
+class MMapIndexedDatasetBuilder(object):
+    """Streams items into <prefix>.bin and writes <prefix>.idx on finalize().
+
+    Sizes and doc_idx are kept as compact arrays. checkpoint() flushes the
+    data written so far and records progress, so that an interrupted build
+    can continue with resume=True. `meta` is saved with each checkpoint for
+    the caller's own progress (e.g. how many input lines were consumed).
+    """
+
+    def __init__(self, prefix, dtype=np.uint16, resume=False, buffer_size=16 * 1024 * 1024):
+        self._prefix = prefix
+        self._dtype = dtype
+        self._sizes = array("i")
+        self._doc_idx = array("q", [0])
+        self._saved_items = 0
+        self._saved_docs = 0
+        self.meta = {}
+
+        if resume and os.path.exists(progress_file_path(prefix)):
+            with open(progress_file_path(prefix)) as f:
+                progress = json.load(f)
+            assert progress["dtype"] == code(dtype), "dtype differs from the interrupted build"
+            with open(_sizes_tmp_path(prefix), "rb") as f:
+                self._sizes.frombytes(f.read(progress["items"] * self._sizes.itemsize))
+            self._doc_idx = array("q")
+            with open(_doc_idx_tmp_path(prefix), "rb") as f:
+                self._doc_idx.frombytes(f.read(progress["docs"] * self._doc_idx.itemsize))
+            # drop anything written after the last checkpoint
+            for path, size in (
+                (data_file_path(prefix), progress["bin_bytes"]),
+                (_sizes_tmp_path(prefix), progress["items"] * self._sizes.itemsize),
+                (_doc_idx_tmp_path(prefix), progress["docs"] * self._doc_idx.itemsize),
+            ):
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+            self._saved_items = progress["items"]
+            self._saved_docs = progress["docs"]
+            self.meta = progress["meta"]
+            mode = "ab"
+        else:
+            mode = "wb"
+
+        self._data_file = open(data_file_path(prefix), mode, buffering=buffer_size)
+        self._sizes_file = open(_sizes_tmp_path(prefix), mode)
+        self._doc_idx_file = open(_doc_idx_tmp_path(prefix), mode)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def add_item(self, tokens):
+        np_array = np.asarray(tokens, dtype=self._dtype)
+        self._data_file.write(np_array.tobytes(order="C"))
+        self._sizes.append(np_array.size)
+
+    def end_document(self):
+        self._doc_idx.append(len(self._sizes))
+
+    def merge_file_(self, another_prefix):
+        index = MMapIndexedDataset.Index(index_file_path(another_prefix))
+        assert index.dtype == self._dtype
+        offset = len(self._sizes)
+        self._sizes.frombytes(np.asarray(index.sizes, dtype=np.int32).tobytes())
+        self._doc_idx.frombytes((np.asarray(index.doc_idx[1:], dtype=np.int64) + offset).tobytes())
+        del index
+
+        self._data_file.flush()
+        with open(data_file_path(another_prefix), "rb") as f:
+            shutil.copyfileobj(f, self._data_file, 16 * 1024 * 1024)
+
+    def checkpoint(self):
+        self._sizes_file.write(self._sizes[self._saved_items:].tobytes())
+        self._doc_idx_file.write(self._doc_idx[self._saved_docs:].tobytes())
+        for f in (self._data_file, self._sizes_file, self._doc_idx_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self._saved_items = len(self._sizes)
+        self._saved_docs = len(self._doc_idx)
+
+        progress = {
+            "dtype": code(self._dtype),
+            "items": self._saved_items,
+            "docs": self._saved_docs,
+            "bin_bytes": self._data_file.tell(),
+            "meta": self.meta,
+        }
+        tmp = progress_file_path(self._prefix) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(progress, f)
+        os.replace(tmp, progress_file_path(self._prefix))
+
+    def finalize(self):
+        self._data_file.close()
+        self._sizes_file.close()
+        self._doc_idx_file.close()
+        with MMapIndexedDataset.Index.writer(index_file_path(self._prefix), self._dtype) as index:
+            index.write(
+                np.frombuffer(self._sizes, dtype=np.int32),
+                np.frombuffer(self._doc_idx, dtype=np.int64),
+            )
+        for path in (progress_file_path(self._prefix), _sizes_tmp_path(self._prefix), _doc_idx_tmp_path(self._prefix)):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,95 @@
+########################################################################################################
+# Non-blocking checkpoint writer for train_callback
+########################################################################################################
+
+import os, time, shutil, subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+class LocalStorage():
+    # checkpoints end up in a local directory (e.g. proj_dir, which SageMaker uploads at the end)
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, local_path, name):
+        dst = os.path.join(self.root, name)
+        if os.path.abspath(local_path) != os.path.abspath(dst):
+            shutil.move(local_path, dst)
+
+    def delete(self, name):
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+class S3Storage():
+    # s3://bucket/prefix, through the aws cli like the original my_save
+    def __init__(self, uri):
+        self.uri = uri.rstrip('/')
+
+    def put(self, local_path, name):
+        subprocess.run(['aws', 's3', 'mv', local_path, f'{self.uri}/{name}', '--quiet'], check=True)
+
+    def delete(self, name):
+        subprocess.run(['aws', 's3', 'rm', f'{self.uri}/{name}', '--quiet'], check=True)
+
+def make_storage(uri, default_dir):
+    if uri.startswith('s3://'):
+        return S3Storage(uri)
+    return LocalStorage(uri or default_dir)
+
+class AsyncCheckpointWriter():
+    # save() copies the state_dict into reused pinned CPU buffers and returns; torch.save and the
+    # upload run on a background thread. At most one write is in flight, and only the newest
+    # `keep` rotated checkpoints are kept (0 = keep all).
+    def __init__(self, storage, staging_dir, keep=0):
+        self.storage = storage
+        self.staging_dir = staging_dir
+        self.keep = keep
+        self.saved = deque()
+        self.buffers = {}
+        self.pending = None
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def _snapshot(self, state_dict):
+        snapshot = {}
+        for k, t in state_dict.items():
+            buf = self.buffers.get(k)
+            if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+                buf = torch.empty(t.shape, dtype=t.dtype, device='cpu', pin_memory=t.is_cuda)
+                self.buffers[k] = buf
+            buf.copy_(t.detach(), non_blocking=True)
+            snapshot[k] = buf
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return snapshot
+
+    def _write(self, snapshot, name, rotate):
+        local_path = os.path.join(self.staging_dir, name)
+        tmp = local_path + '.tmp'
+        torch.save(snapshot, tmp)
+        os.replace(tmp, local_path)
+        self.storage.put(local_path, name)
+        if rotate:
+            self.saved.append(name)
+            while self.keep > 0 and len(self.saved) > self.keep:
+                self.storage.delete(self.saved.popleft())
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def save(self, state_dict, name, rotate=True):
+        # returns the seconds the training loop was blocked (waiting for the previous write + snapshot)
+        t0 = time.time()
+        self.wait()  # the pinned buffers are reused, so the previous write must be done
+        snapshot = self._snapshot(state_dict)
+        self.pending = self.pool.submit(self._write, snapshot, name, rotate)
+        return time.time() - t0
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
@@ -5,10 +5,29 @@
 import json, math, random, os, sys
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from pytorch_lightning.utilities import rank_zero_info
 from .binidx import MMapIndexedDataset
 from .utils import MaybeIsPrime
+from .qa_mask import qa_mask, qa_mask_from_spans, qa_spans_file_path
+
+
+class WindowBatchSampler(Sampler):
+    # yields one array of random window offsets per micro-batch
+    # use with DataLoader(dataset, sampler=..., batch_size=None) so MyDataset reads each batch at once
+    def __init__(self, data_size, req_len, batch_size, num_batches, seed=None):
+        self.data_size = data_size
+        self.req_len = req_len
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            yield self.rng.integers(0, self.data_size - self.req_len, size=self.batch_size)
 
 
 class MyDataset(Dataset):
@@ -29,12 +48,17 @@ class MyDataset(Dataset):
                 exit(0)
             else:
                 self.data = MMapIndexedDataset(args.data_file)
-                self.data_size = len(self.data._bin_buffer) // 2
+                self.data_size = len(self.data._bin_buffer) // np.dtype(self.data._index.dtype).itemsize
                 rank_zero_info(f"Data has {self.data_size} tokens.")
 
             if args.my_qa_mask > 0:
                 self.data_pile = MMapIndexedDataset('/fsx/BlinkDL/pile/pile_20B_tokenizer_text_document')
-                self.data_pile_size = len(self.data_pile._bin_buffer) // 2
+                self.data_pile_size = len(self.data_pile._bin_buffer) // np.dtype(self.data_pile._index.dtype).itemsize
+                # optional sidecar from `make_data.py --qa_spans`
+                self.qa_spans = None
+                if os.path.exists(qa_spans_file_path(args.data_file)):
+                    self.qa_spans = np.load(qa_spans_file_path(args.data_file), mmap_mode="r")
+                    rank_zero_info(f"Using QA mask spans from {qa_spans_file_path(args.data_file)}")
 
             if args.my_pile_stage > 0:
                 # assert self.data_size == 332115325534 and self.vocab_size == 50277
@@ -47,13 +71,13 @@ class MyDataset(Dataset):
                     assert args.magic_prime % 3 == 2
                     assert args.magic_prime / dataset_slot > 0.99 and args.magic_prime / dataset_slot <= 1
         elif args.data_type == "numpy":
-            self.data = np.load(args.data_file).astype("int")
+            self._open_data()
             self.vocab_size = args.vocab_size
             rank_zero_info("Current vocab size =", self.vocab_size, "(make sure it's correct)")
             self.data_size = len(self.data)
             rank_zero_info(f"Data has {self.data_size} tokens.")
         elif args.data_type == "uint16":
-            self.data = np.fromfile(args.data_file, dtype=np.uint16).astype("int32").reshape(-1, args.my_sample_len)
+            self._open_data()
             self.vocab_size = args.vocab_size
             rank_zero_info("Current vocab size =", self.vocab_size, "(make sure it's correct)")
             self.data_size = self.data.shape[0]
@@ -93,11 +117,37 @@ class MyDataset(Dataset):
             self.stoi = {ch: i for i, ch in enumerate(unique)}
             self.itos = {i: ch for i, ch in enumerate(unique)}
 
+    def _open_data(self):
+        # memory-mapped in the file's own dtype; samples are widened to int64 one at a time
+        args = self.args
+        if args.data_type == "numpy":
+            self.data = np.load(args.data_file, mmap_mode="r")
+        elif args.data_type == "uint16":
+            self.data = np.memmap(args.data_file, dtype=np.uint16, mode="r").reshape(-1, args.my_sample_len)
+
+    def __getstate__(self):
+        # DataLoader workers re-open the memmap instead of receiving a pickled copy of the corpus
+        state = self.__dict__.copy()
+        if self.args.data_type in ["numpy", "uint16"]:
+            state["data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.args.data_type in ["numpy", "uint16"]:
+            self._open_data()
+
     def __len__(self):
         return self.args.epoch_steps * self.args.micro_bsz
 
     def __getitem__(self, idx):
         args = self.args
+
+        if isinstance(idx, np.ndarray):
+            # a micro-batch of offsets from WindowBatchSampler (binidx only)
+            dix = self.data.get_batch(idx, args.ctx_len + 1)
+            return dix[:, :-1], dix[:, 1:]
+
         rank = self.global_rank
         epoch = self.real_epoch
         world_size = self.world_size
@@ -145,7 +195,7 @@ class MyDataset(Dataset):
         else:
             if args.data_type == "uint16":
                 i = np.random.randint(0, self.data_size-1)
-                dix = self.data[i]
+                dix = self.data[i].astype(np.int64)
                 x = torch.tensor(dix[:-1], dtype=torch.long)
                 y = torch.tensor(dix[1:], dtype=torch.long)
             else:
@@ -184,27 +234,20 @@ class MyDataset(Dataset):
                 if args.data_type == "binidx":
                     dix = data.get(idx=0, offset=i, length=req_len).astype(int)
                 elif args.data_type == "numpy":
-                    dix = data[i : i + req_len]
+                    dix = data[i : i + req_len].astype(np.int64)
                 else:
                     dix = [self.stoi[s] for s in data[i : i + req_len]]
 
                 if args.my_qa_mask == 1:
                     if data == self.data_pile:
-                        z = [1] * ctx_len
+                        z = np.ones(ctx_len, dtype=bool)
                     else:
-                        z = [0] * ctx_len
-                        z_sum = 0
-                        isGood = False
-                        for i in range(3, ctx_len):
-                            if dix[i] == 27 and dix[i-1] == 34 and dix[i-2] == 187 and dix[i-3] == 187:
-                                isGood = True
-                            if dix[i] == 0:
-                                isGood = False
-                            if isGood:
-                                z[i] = 1
-                                z_sum += 1
-                        if z_sum == 0:
-                            z = [1] * ctx_len
+                        if self.qa_spans is not None:
+                            z = qa_mask_from_spans(self.qa_spans, i, ctx_len)
+                        else:
+                            z = qa_mask(dix, ctx_len)
+                        if not z.any():
+                            z = np.ones(ctx_len, dtype=bool)
                             i = np.random.randint(0, self.data_pile_size - req_len)
                             dix = self.data_pile.get(idx=0, offset=i, length=req_len).astype(int)
                     z = torch.tensor(z, dtype=torch.bfloat16)
@@ -0,0 +1,91 @@
+########################################################################################################
+# Merge LoRA weights into an RWKV checkpoint (shared by inference.py and src/model_run.py)
+# Original: https://github.com/Blealtan/RWKV-LM-LoRA/blob/main/RWKV-v4neo/merge_lora.py
+########################################################################################################
+
+import os, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+import torch
+
+def load_state_dict(path) -> Dict[str, torch.Tensor]:
+    # memory-mapped where possible, so only the tensors we touch are read into RAM
+    if path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path, device='cpu')
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1, or a checkpoint saved in the legacy (non-zip) format
+        return torch.load(path, map_location='cpu')
+
+def merge_lora_weights(w, w_lora, lora_alpha, device='cpu', out_device=None, workers=4):
+    # merge in place: w[k] += lora_B @ lora_A * (alpha / r) for every k with a LoRA pair,
+    # one layer per worker thread; the lora_A / lora_B keys are removed from w
+    for k in w_lora.keys():
+        w[k] = w_lora[k]
+
+    def merge_one(k):
+        prefix = k[:-len('.weight')]
+        lora_A = w[prefix + '.lora_A'].to(device)
+        lora_B = w[prefix + '.lora_B'].to(device)
+        assert lora_B.shape[1] == lora_A.shape[0]
+        scale = lora_alpha / lora_B.shape[1]
+        weight = w[k].to(device)
+        if weight.dtype == lora_A.dtype == lora_B.dtype:
+            weight.addmm_(lora_B, lora_A, alpha=scale)
+        else:
+            weight.add_(lora_B.float() @ lora_A.float(), alpha=scale)
+        w[k] = weight if out_device is None else weight.to(out_device)
+        return k
+
+    targets = [k for k in w.keys() if k.endswith('.weight') and k[:-len('.weight')] + '.lora_A' in w]
+    with torch.no_grad(), ThreadPoolExecutor(max_workers=workers) as pool:
+        for k in pool.map(merge_one, targets):
+            print(f'merged LoRA into {k}')
+
+    for k in list(w.keys()):
+        if '.lora_' in k:
+            del w[k]
+    return w
+
+def _fingerprint(path, full=True, block=1 << 20, samples=16):
+    # sha256 of the file size and its whole contents; full=False hashes only `samples`
+    # evenly spaced blocks instead (faster for multi-GB checkpoints, but two files that
+    # differ only outside those blocks get the same fingerprint).
+    # The DJL handler (Transformers/djl_scripts/inference.py) uses the same scheme.
+    h = hashlib.sha256()
+    size = os.path.getsize(path)
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        if full or size <= block * samples:
+            while True:
+                chunk = f.read(block * 16)
+                if not chunk:
+                    break
+                h.update(chunk)
+        else:
+            for i in range(samples):
+                f.seek((size - block) * i // (samples - 1))
+                h.update(f.read(block))
+    return h.hexdigest()
+
+def merged_model_path(base_model, lora, lora_alpha=32, cache_dir='/tmp/rwkv_merged', device='cpu', workers=4):
+    # path of the merged checkpoint for (base_model, lora, lora_alpha); merges only on a cache miss
+    key = hashlib.sha256(
+        f'{_fingerprint(base_model)}:{_fingerprint(lora)}:{lora_alpha}'.encode()
+    ).hexdigest()[:32]
+    output = os.path.join(cache_dir, f'merged-{key}.pth')
+    if os.path.exists(output):
+        print(f'Using cached merged model {output}')
+        return output
+
+    os.makedirs(cache_dir, exist_ok=True)
+    w = merge_lora_weights(
+        load_state_dict(base_model), load_state_dict(lora), lora_alpha,
+        device=device, out_device='cpu', workers=workers,
+    )
+    tmp = output + '.tmp'
+    torch.save(w, tmp)
+    os.replace(tmp, output)
+    return output
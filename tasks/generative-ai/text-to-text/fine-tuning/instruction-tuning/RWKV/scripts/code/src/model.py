@@ -579,7 +579,7 @@ class RWKV(pl.LightningModule):
         if args.my_qa_mask != 1:
             idx, targets = batch
             logits = self(idx)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1))
         else:
             idx, targets, mask = batch
             mask = mask.view(-1)
@@ -589,10 +589,10 @@ class RWKV(pl.LightningModule):
 
             logits = self(idx)
             if sum_mask == mask.shape[0]:
-                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1))
                 # print('rank', self.global_rank, 'loss', loss.item())
             else:
-                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), reduction='none')
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), reduction='none')
                 # loss_raw = loss
                 loss = torch.sum(loss * mask) / sum_mask
 
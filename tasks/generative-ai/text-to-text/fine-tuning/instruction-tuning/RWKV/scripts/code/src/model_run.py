@@ -8,6 +8,7 @@ import math, os, gc
 from torch.nn import functional as F
 import torch.nn as nn
 from typing import List, Dict
+from .lora_merge import load_state_dict, merge_lora_weights
 
 MyModule = nn.Module
 def __nop(ob):
@@ -41,32 +42,12 @@ class RWKV_RNN(MyModule):
         self.RUN_DEVICE = args.RUN_DEVICE
 
         with torch.no_grad():
-            w = torch.load(args.MODEL_NAME + '.pth', map_location='cpu')
+            w = load_state_dict(args.MODEL_NAME + '.pth')
             if args.lora_r > 0:
                 # merge LoRA-only slim checkpoint into the main weights
-                w_lora = torch.load(args.MODEL_LORA + '.pth', map_location='cpu')
-                for k in w_lora.keys():
-                    w[k] = w_lora[k]
-                # merge LoRA weights
-                keys = set(w.keys())
-                for k in keys:
-                    k: str
-                    if k.endswith('.weight'):
-                        prefix = k[:-len('.weight')]
-                        lora_A = prefix + '.lora_A'
-                        lora_B = prefix + '.lora_B'
-                        if lora_A in keys:
-                            assert lora_B in keys
-                            print(f'merging {lora_A} and {lora_B} into {k}')
-                            assert w[lora_B].shape[1] == w[lora_A].shape[0] == args.lora_r
-                            # merging needs matmul, which is slow on cpu; work on gpu if possible
-                            if args.RUN_DEVICE == 'cuda':
-                                w[k] = w[k].cuda()
-                                w[lora_A] = w[lora_A].cuda()
-                                w[lora_B] = w[lora_B].cuda()
-                            w[k] += w[lora_B] @ w[lora_A] * (args.lora_alpha / args.lora_r)
-                            del w[lora_A]
-                            del w[lora_B]
+                # merging needs matmul, which is slow on cpu; work on gpu if possible
+                w = merge_lora_weights(w, load_state_dict(args.MODEL_LORA + '.pth'), args.lora_alpha,
+                                       device='cuda' if args.RUN_DEVICE == 'cuda' else 'cpu')
             # refine weights and send to correct device
             keys = list(w.keys())
             if 'pos_emb_x' in keys:
@@ -141,6 +122,24 @@ class RWKV_RNN(MyModule):
     def LN(self, x, w):
         return F.layer_norm(x, (self.args.n_embd,), weight=w.weight, bias=w.bias)
 
+    def init_state(self, batch_size = None):
+        # (n_layer*5, n_embd) for a single sequence, (batch_size, n_layer*5, n_embd) for forward_batch
+        args = self.args
+        if batch_size == None:
+            state = torch.zeros(args.n_layer * 5, args.n_embd, device=self.RUN_DEVICE)
+        else:
+            state = torch.zeros(batch_size, args.n_layer * 5, args.n_embd, device=self.RUN_DEVICE)
+        state[..., 4::5, :] = -1e30
+        return state
+
+    def batch_states(self, states: List):
+        # stack per-sequence states (None = fresh sequence) so sequences can join the batch between steps
+        return torch.stack([self.init_state() if s == None else s.to(self.RUN_DEVICE) for s in states])
+
+    def unbatch_states(self, state):
+        # split a batched state back into per-sequence states so sequences can leave the batch
+        return list(state.unbind(0))
+
     # state[] 0=ffn_xx 1=att_xx 2=att_aa 3=att_bb 4=att_pp
 
     @MyFunction
@@ -217,6 +216,149 @@ class RWKV_RNN(MyModule):
         
         return ow @ (r * wkv)
 
+    # batched variants of FF / SA: x is (B, n_embd), state is (B, n_layer*5, n_embd)
+
+    @MyFunction
+    def FF_batch(self, x, state, i:int, time_mix_k, time_mix_r, kw, vw, rw):
+        if self.FLOAT_MODE == "bf16":
+            xk = x * time_mix_k + state[:, 5*i+0].type(torch.bfloat16) * (1 - time_mix_k)
+            xr = x * time_mix_r + state[:, 5*i+0].type(torch.bfloat16) * (1 - time_mix_r)
+            state[:, 5*i+0] = x.float()
+        elif self.FLOAT_MODE == "fp16":
+            xk = x * time_mix_k + state[:, 5*i+0].half() * (1 - time_mix_k)
+            xr = x * time_mix_r + state[:, 5*i+0].half() * (1 - time_mix_r)
+            state[:, 5*i+0] = x.float()
+        else:
+            xk = x * time_mix_k + state[:, 5*i+0] * (1 - time_mix_k)
+            xr = x * time_mix_r + state[:, 5*i+0] * (1 - time_mix_r)
+            state[:, 5*i+0] = x
+
+        r = torch.sigmoid(xr @ rw.t())
+        k = torch.square(torch.relu(xk @ kw.t()))
+        kv = k @ vw.t()
+
+        return r * kv
+
+    @MyFunction
+    def SA_batch(self, x, state, i:int, time_mix_k, time_mix_v, time_mix_r, time_first, time_decay, kw, vw, rw, ow):
+        if self.FLOAT_MODE == "bf16":
+            xk = x * time_mix_k + state[:, 5*i+1].type(torch.bfloat16) * (1 - time_mix_k)
+            xv = x * time_mix_v + state[:, 5*i+1].type(torch.bfloat16) * (1 - time_mix_v)
+            xr = x * time_mix_r + state[:, 5*i+1].type(torch.bfloat16) * (1 - time_mix_r)
+            state[:, 5*i+1] = x.float()
+        elif self.FLOAT_MODE == "fp16":
+            xk = x * time_mix_k + state[:, 5*i+1].half() * (1 - time_mix_k)
+            xv = x * time_mix_v + state[:, 5*i+1].half() * (1 - time_mix_v)
+            xr = x * time_mix_r + state[:, 5*i+1].half() * (1 - time_mix_r)
+            state[:, 5*i+1] = x.float()
+        else:
+            xk = x * time_mix_k + state[:, 5*i+1] * (1 - time_mix_k)
+            xv = x * time_mix_v + state[:, 5*i+1] * (1 - time_mix_v)
+            xr = x * time_mix_r + state[:, 5*i+1] * (1 - time_mix_r)
+            state[:, 5*i+1] = x
+
+        r = torch.sigmoid(xr @ rw.t())
+        k = xk @ kw.t()
+        v = xv @ vw.t()
+
+        if '16' in self.FLOAT_MODE:
+            kk = k.float()
+            vv = v.float()
+        else:
+            kk = k
+            vv = v
+        aa = state[:, 5*i+2]
+        bb = state[:, 5*i+3]
+        pp = state[:, 5*i+4]
+        ww = time_first + kk
+        p = torch.maximum(pp, ww)
+        e1 = torch.exp(pp - p)
+        e2 = torch.exp(ww - p)
+        a = e1 * aa + e2 * vv
+        b = e1 * bb + e2
+        ww = pp + time_decay
+        p = torch.maximum(ww, kk)
+        e1 = torch.exp(ww - p)
+        e2 = torch.exp(kk - p)
+        state[:, 5*i+2] = e1 * aa + e2 * vv
+        state[:, 5*i+3] = e1 * bb + e2
+        state[:, 5*i+4] = p
+        if self.FLOAT_MODE == "bf16":
+            wkv = (a / b).type(torch.bfloat16)
+        elif self.FLOAT_MODE == "fp16":
+            wkv = (a / b).half()
+        else:
+            wkv = a / b
+
+        return (r * wkv) @ ow.t()
+
+    # chunked variants of FF / SA for prompt prefill: x is (T, n_embd), state is (n_layer*5, n_embd)
+
+    @MyFunction
+    def FF_chunk(self, x, state, i:int, time_mix_k, time_mix_r, kw, vw, rw):
+        xx = torch.cat((state[5*i+0].to(dtype=x.dtype).unsqueeze(0), x[:-1]))
+        xk = x * time_mix_k + xx * (1 - time_mix_k)
+        xr = x * time_mix_r + xx * (1 - time_mix_r)
+        state[5*i+0] = x[-1].float()
+
+        r = torch.sigmoid(xr @ rw.t())
+        k = torch.square(torch.relu(xk @ kw.t()))
+        kv = k @ vw.t()
+
+        return r * kv
+
+    @MyFunction
+    def WKV_chunk(self, k, v, state, i:int, time_first, time_decay):
+        # closed form of the SA recurrence over a whole chunk:
+        #   A[t] = sum_j exp((t-1-j) * time_decay) * exp(k[j]) * v[j]   (j = -1 is the incoming state)
+        # evaluated as a cumulative log-sum-exp scan; float64 because j * time_decay gets large
+        w = time_decay.double()
+        u = time_first.double()
+        kk = k.double()
+        vv = v.double()
+        aa = state[5*i+2].double()
+        bb = state[5*i+3].double()
+        pp = state[5*i+4].double()
+
+        n = torch.arange(-1, kk.shape[0], device=kk.device, dtype=torch.float64).unsqueeze(1)
+        shift = n * w
+        lb = torch.cat(((pp + torch.log(bb)).unsqueeze(0), kk))
+        la_pos = torch.cat(((pp + torch.log(torch.relu(aa))).unsqueeze(0), kk + torch.log(torch.relu(vv))))
+        la_neg = torch.cat(((pp + torch.log(torch.relu(-aa))).unsqueeze(0), kk + torch.log(torch.relu(-vv))))
+        # row r holds the decayed sums over terms j < r, i.e. the state seen by token r
+        lb = torch.logcumsumexp(lb - shift, dim=0) + shift
+        la_pos = torch.logcumsumexp(la_pos - shift, dim=0) + shift
+        la_neg = torch.logcumsumexp(la_neg - shift, dim=0) + shift
+
+        ww = u + kk
+        p = torch.maximum(lb[:-1], ww)
+        e2 = torch.exp(ww - p)
+        a = torch.exp(la_pos[:-1] - p) - torch.exp(la_neg[:-1] - p) + e2 * vv
+        b = torch.exp(lb[:-1] - p) + e2
+
+        p = lb[-1]
+        state[5*i+2] = (torch.exp(la_pos[-1] - p) - torch.exp(la_neg[-1] - p)).float()
+        state[5*i+3] = torch.ones_like(p).float()
+        state[5*i+4] = p.float()
+
+        return (a / b).float()
+
+    @MyFunction
+    def SA_chunk(self, x, state, i:int, time_mix_k, time_mix_v, time_mix_r, time_first, time_decay, kw, vw, rw, ow):
+        xx = torch.cat((state[5*i+1].to(dtype=x.dtype).unsqueeze(0), x[:-1]))
+        xk = x * time_mix_k + xx * (1 - time_mix_k)
+        xv = x * time_mix_v + xx * (1 - time_mix_v)
+        xr = x * time_mix_r + xx * (1 - time_mix_r)
+        state[5*i+1] = x[-1].float()
+
+        r = torch.sigmoid(xr @ rw.t())
+        k = xk @ kw.t()
+        v = xv @ vw.t()
+
+        wkv = self.WKV_chunk(k, v, state, i, time_first, time_decay)
+
+        return (r * wkv.to(dtype=r.dtype)) @ ow.t()
+
     def forward(self, ctx, state, preprocess_only = False):
         with torch.no_grad():
             w = self.w
@@ -232,9 +374,7 @@ class RWKV_RNN(MyModule):
                 pass             
 
             if state == None:
-                state = torch.zeros(args.n_layer * 5, args.n_embd, device=self.RUN_DEVICE)
-                for i in range(args.n_layer):
-                    state[5*i+4] -= 1e30
+                state = self.init_state()
 
             for i in range(args.n_layer):
                 if i == 0:
@@ -260,3 +400,105 @@ class RWKV_RNN(MyModule):
             x = w.head.weight @ x
 
             return x.float(), state
+
+    def forward_batch(self, ctxs: List[List[int]], state, preprocess_only = False):
+        # advance len(ctxs) independent sequences by one token each
+        # state: None, or (B, n_layer*5, n_embd) with rows in the same order as ctxs
+        with torch.no_grad():
+            w = self.w
+            args = self.args
+
+            x = w.emb.weight[[ctx[-1] for ctx in ctxs]]
+            if self.RUN_DEVICE == 'cuda':
+                x = x.cuda()
+            try:
+                pos_emb = w.pos_emb[[len(ctx)-1 for ctx in ctxs]]
+                x = x + pos_emb
+            except:
+                pass
+
+            if state == None:
+                state = self.init_state(len(ctxs))
+            assert state.shape[0] == len(ctxs)
+
+            for i in range(args.n_layer):
+                if i == 0:
+                    x = self.LN(x, w.blocks[i].ln0)
+
+                ww = w.blocks[i].att
+                x = x + self.SA_batch(self.LN(x, w.blocks[i].ln1), state, i,
+                    ww.time_mix_k, ww.time_mix_v, ww.time_mix_r, ww.time_first, ww.time_decay,
+                    ww.key.weight, ww.value.weight, ww.receptance.weight, ww.output.weight)
+
+                ww = w.blocks[i].ffn
+                x = x + self.FF_batch(self.LN(x, w.blocks[i].ln2), state, i,
+                    ww.time_mix_k, ww.time_mix_r,
+                    ww.key.weight, ww.value.weight, ww.receptance.weight)
+
+                if (i+1) % RWKV_RESCALE_LAYER == 0:
+                    x = x / 2
+
+            if preprocess_only:
+                return state
+
+            x = self.LN(x, w.ln_out)
+            x = x @ w.head.weight.t()
+
+            return x.float(), state
+
+    def forward_prefill(self, ctx, state, start = 0, chunk_len = 256, preprocess_only = True):
+        # ingest ctx[start:] chunk_len tokens at a time; same result as calling forward() once per token
+        with torch.no_grad():
+            w = self.w
+            args = self.args
+
+            if state == None:
+                state = self.init_state()
+
+            for s in range(start, len(ctx), chunk_len):
+                tokens = ctx[s : s + chunk_len]
+                x = w.emb.weight[tokens]
+                if self.RUN_DEVICE == 'cuda':
+                    x = x.cuda()
+                try:
+                    pos_emb = w.pos_emb[torch.arange(s, s + len(tokens))]
+                    x = x + pos_emb
+                except:
+                    pass
+
+                for i in range(args.n_layer):
+                    if i == 0:
+                        x = self.LN(x, w.blocks[i].ln0)
+
+                    ww = w.blocks[i].att
+                    x = x + self.SA_chunk(self.LN(x, w.blocks[i].ln1), state, i,
+                        ww.time_mix_k, ww.time_mix_v, ww.time_mix_r, ww.time_first, ww.time_decay,
+                        ww.key.weight, ww.value.weight, ww.receptance.weight, ww.output.weight)
+
+                    ww = w.blocks[i].ffn
+                    x = x + self.FF_chunk(self.LN(x, w.blocks[i].ln2), state, i,
+                        ww.time_mix_k, ww.time_mix_r,
+                        ww.key.weight, ww.value.weight, ww.receptance.weight)
+
+                    if (i+1) % RWKV_RESCALE_LAYER == 0:
+                        x = x / 2
+
+            if preprocess_only:
+                return state
+
+            x = self.LN(x[-1], w.ln_out)
+            x = w.head.weight @ x
+
+            return x.float(), state
+
+    def forward_cached(self, ctx, state_cache, checkpoints = (), chunk_len = 256):
+        # resume from the longest prefix of ctx found in state_cache (a src.state_cache.StateCache),
+        # prefill the rest, and store the states at the given prefix lengths and at len(ctx)-1
+        n, state = state_cache.lookup(ctx[:-1])
+        ends = sorted(set(c for c in checkpoints if n < c < len(ctx)) | {len(ctx) - 1})
+        for end in ends:
+            if n < end:
+                state = self.forward_prefill(ctx[:end], state, start=n, chunk_len=chunk_len)
+                n = end
+                state_cache.put(ctx[:end], state)
+        return self.forward(ctx, state)
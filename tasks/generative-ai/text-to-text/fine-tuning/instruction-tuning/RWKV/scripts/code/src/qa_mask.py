@@ -0,0 +1,64 @@
+########################################################################################################
+# Loss mask for my_qa_mask training: train only on the answer part of each sample
+########################################################################################################
+
+import os
+import numpy as np
+
+# a span starts at the last token of the "\n\nA:" marker and runs until the next 0 (<|endoftext|>)
+QA_MARKER = (187, 187, 34, 27)
+
+def qa_spans_file_path(prefix_path):
+    return prefix_path + ".qa_spans.npy"
+
+def _marker_ends(tokens, base=0):
+    # positions p (>= 3 within tokens) where tokens[p-3 : p+1] == QA_MARKER, offset by base
+    m = np.ones(len(tokens) - 3, dtype=bool) if len(tokens) > 3 else np.zeros(0, dtype=bool)
+    for k, t in enumerate(QA_MARKER):
+        m &= tokens[k : len(tokens) - 3 + k] == t
+    return np.nonzero(m)[0] + 3 + base
+
+def qa_mask(dix, ctx_len):
+    # vectorized form of the per-token loop: z[i] = 1 when the latest event at or before i
+    # (i >= 3) is the end of a QA_MARKER rather than a 0
+    d = np.asarray(dix[:ctx_len])
+    event = np.zeros(ctx_len, dtype=np.int8)
+    event[3:] = np.where(d[3:] == 0, -1, 0)
+    event[_marker_ends(d)] = 1
+    last = np.maximum.accumulate(np.where(event != 0, np.arange(ctx_len), -1))
+    return (last >= 0) & (event[np.maximum(last, 0)] == 1)
+
+def build_qa_spans(tokens, chunk_len=1 << 24):
+    # precompute [start, end) spans over the whole token stream: start = end of a marker,
+    # end = next 0 or next marker, so a window only has to look up the spans it contains
+    markers = []
+    zeros = []
+    for s in range(0, len(tokens), chunk_len):
+        lo = max(0, s - 3)
+        chunk = np.asarray(tokens[lo : s + chunk_len])
+        ends = _marker_ends(chunk, lo)
+        markers.append(ends[ends >= s])
+        zeros.append(np.nonzero(chunk[s - lo :] == 0)[0] + s)
+    markers = np.concatenate(markers) if markers else np.zeros(0, dtype=np.int64)
+    zeros = np.concatenate(zeros) if zeros else np.zeros(0, dtype=np.int64)
+
+    zeros = np.append(zeros, len(tokens))
+    next_zero = zeros[np.searchsorted(zeros, markers, side="right")]
+    next_marker = np.append(markers[1:], len(tokens))
+    return np.stack([markers, np.minimum(next_zero, next_marker)], axis=1).astype(np.int64)
+
+def save_qa_spans(prefix_path, tokens):
+    spans = build_qa_spans(tokens)
+    tmp = qa_spans_file_path(prefix_path) + ".tmp.npy"
+    np.save(tmp, spans)
+    os.replace(tmp, qa_spans_file_path(prefix_path))
+    return spans
+
+def qa_mask_from_spans(spans, offset, ctx_len):
+    # same result as qa_mask(tokens[offset : offset + ctx_len], ctx_len), from precomputed spans
+    z = np.zeros(ctx_len, dtype=bool)
+    lo = np.searchsorted(spans[:, 0], offset + 3, side="left")
+    hi = np.searchsorted(spans[:, 0], offset + ctx_len, side="left")
+    for start, end in spans[lo:hi]:
+        z[start - offset : min(end, offset + ctx_len) - offset] = True
+    return z
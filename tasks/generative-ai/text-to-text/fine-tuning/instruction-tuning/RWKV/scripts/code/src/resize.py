@@ -0,0 +1,50 @@
+########################################################################################################
+# Resize checkpoint tensors by linear interpolation (stage-1 model growth, resize_model.py)
+########################################################################################################
+
+import torch
+
+def _interp_index(ss, dd, device):
+    # for output row i: pos = i / dd * ss, lerp between src[p0] and src[p0+1] (src[ss-1] past the end)
+    pos = torch.arange(dd, dtype=torch.float64, device=device) / dd * ss
+    p0 = pos.floor().long().clamp_(max=ss - 1)
+    p1 = (p0 + 1).clamp_(max=ss - 1)
+    ii = torch.where(pos >= ss - 1, torch.zeros_like(pos), pos - p0)
+    return p0, p1, ii
+
+def resize_tensor(src, shape, device=None, dtype=None):
+    # resize src to shape, interpolating every axis whose size differs with one gather + lerp per axis;
+    # size-1 axes are ignored on both sides, so (1, 1, C) time_ params resize like (C,)
+    shape = torch.Size(shape)
+    dtype = dtype or src.dtype
+    x = src.squeeze()
+    target = torch.Size([d for d in shape if d != 1])
+    assert x.dim() == len(target), f"cannot resize {tuple(src.shape)} to {tuple(shape)}"
+
+    compute_dtype = torch.float64 if x.dtype == torch.float64 else torch.float32
+    x = x.to(device=device or src.device, dtype=compute_dtype)
+    for dim, (ss, dd) in enumerate(zip(x.shape, target)):
+        if ss == dd:
+            continue
+        p0, p1, ii = _interp_index(ss, dd, x.device)
+        view = [1] * x.dim()
+        view[dim] = dd
+        ii = ii.to(compute_dtype).view(view)
+        x = x.index_select(dim, p0) * (1 - ii) + x.index_select(dim, p1) * ii
+    return x.reshape(shape).to(dtype)
+
+def resize_state_dict(src_dict, target_dict, device=None, verbose=True):
+    # copy every tensor of src_dict into the shapes of target_dict; keys only in target_dict keep
+    # their (freshly initialized) values
+    out = dict(target_dict)
+    for k in src_dict:
+        assert k in target_dict, f"{k} not in target model"
+        src = src_dict[k]
+        dst = target_dict[k]
+        if src.numel() == dst.numel():
+            out[k] = src.reshape(dst.shape).to(dst.dtype)
+            continue
+        out[k] = resize_tensor(src, dst.shape, device=device, dtype=dst.dtype).to(dst.device)
+        if verbose:
+            print(k, tuple(src.shape), '-->', tuple(dst.shape))
+    return out
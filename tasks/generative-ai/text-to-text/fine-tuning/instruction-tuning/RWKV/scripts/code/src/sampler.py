@@ -0,0 +1,61 @@
+########################################################################################################
+# Top-k / top-p / temperature sampling without a full-vocabulary sort
+########################################################################################################
+
+import torch
+from torch.nn import functional as F
+
+# number of candidates taken with topk before the nucleus cut when top_k is not set; a row
+# whose top_p mass is not reached within them samples from these candidates (pass
+# full_sort=True to sort the whole vocabulary instead)
+NUCLEUS_CANDIDATES = 256
+
+def make_generator(seed, device='cpu'):
+    # seeded generator on the logits' device, for reproducible sampling
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(seed))
+    return generator
+
+def _per_row(value, rows, device):
+    # a float is filled on the device (no host-to-device copy, which would wait for the GPU)
+    if isinstance(value, torch.Tensor):
+        return value.to(device=device, dtype=torch.float32).reshape(-1, 1).expand(rows, 1)
+    return torch.full((rows, 1), float(value), dtype=torch.float32, device=device)
+
+def sample_logits(logits, temperature=1.0, top_p=0.85, top_k=0, generator=None, full_sort=False):
+    # logits: (vocab,) -> int, or (B, vocab) -> (B,) tensor on the logits' device
+    # temperature / top_p may be floats or (B,) tensors; temperature <= 0 means greedy.
+    # Everything stays on the device (no host sync) until the (vocab,) case returns an int.
+    single = logits.dim() == 1
+    if single:
+        logits = logits.unsqueeze(0)
+    rows, vocab = logits.shape
+    device = logits.device
+
+    temperature = _per_row(temperature, rows, device)
+    top_p = _per_row(top_p, rows, device)
+    greedy = temperature <= 0
+    temperature = torch.where(greedy, torch.ones_like(temperature), temperature)
+    top_p = torch.where(greedy, torch.zeros_like(top_p), top_p)
+
+    probs = F.softmax(logits.float(), dim=-1)
+
+    # partial selection: only the top candidates are sorted
+    if top_k <= 0 and full_sort:
+        sorted_probs, sorted_ids = torch.sort(probs, dim=-1, descending=True)
+    else:
+        k = min(int(top_k) if top_k > 0 else NUCLEUS_CANDIDATES, vocab)
+        sorted_probs, sorted_ids = torch.topk(probs, k, dim=-1)
+    cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+
+    # nucleus: keep tokens until the cumulative probability reaches top_p (at least one)
+    keep = (cumulative_probs - sorted_probs) < top_p
+    keep[:, 0] = True
+    sorted_probs = torch.where(keep, sorted_probs, torch.zeros_like(sorted_probs))
+    sorted_probs = sorted_probs.pow(1.0 / temperature)
+
+    choice = torch.multinomial(sorted_probs, num_samples=1, generator=generator)
+    tokens = sorted_ids.gather(-1, choice).squeeze(-1)
+    if single:
+        return int(tokens[0])
+    return tokens
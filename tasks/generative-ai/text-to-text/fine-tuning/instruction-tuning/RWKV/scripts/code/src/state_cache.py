@@ -0,0 +1,132 @@
+########################################################################################################
+# RWKV state cache keyed by token prefix
+########################################################################################################
+
+import os, json, hashlib
+from array import array
+from collections import OrderedDict
+import numpy as np
+import torch
+
+# The whole context of an RWKV model is its fixed-size state, so the state after a prompt prefix
+# (e.g. the instruction header every request shares) can be stored and resumed from directly.
+# A state is either a single tensor (src.model_run.RWKV_RNN) or a list of tensors (rwkv package).
+
+def prefix_key(tokens):
+    return hashlib.sha1(array('q', tokens).tobytes()).hexdigest()
+
+def _tensors(state):
+    return list(state) if isinstance(state, (list, tuple)) else [state]
+
+def _clone(state):
+    if isinstance(state, (list, tuple)):
+        return [s.clone() for s in state]
+    return state.clone()
+
+def _nbytes(state):
+    return sum(t.numel() * t.element_size() for t in _tensors(state))
+
+class StateCache():
+    def __init__(self, max_bytes=512 * 1024 * 1024, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.mem = OrderedDict()    # key -> (prefix length, state), in LRU order
+        self.disk = {}              # key -> prefix length, for states spilled to spill_dir
+        self.lengths = {}           # prefix length -> number of cached keys with that length
+        self.mem_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            for p in os.listdir(spill_dir):
+                if p.endswith('.json'):
+                    with open(os.path.join(spill_dir, p)) as f:
+                        self._add_key(p[:-5], json.load(f)['length'], on_disk=True)
+
+    def _add_key(self, key, n, on_disk=False):
+        if key not in self.mem and key not in self.disk:
+            self.lengths[n] = self.lengths.get(n, 0) + 1
+        if on_disk:
+            self.disk[key] = n
+
+    def _drop_key(self, n):
+        self.lengths[n] -= 1
+        if self.lengths[n] == 0:
+            del self.lengths[n]
+
+    def _insert(self, key, n, state):
+        self._add_key(key, n)
+        self.mem[key] = (n, state)
+        self.mem_bytes += _nbytes(state)
+        while self.mem_bytes > self.max_bytes and len(self.mem) > 0:
+            old_key, (old_n, old_state) = self.mem.popitem(last=False)
+            self.mem_bytes -= _nbytes(old_state)
+            if self.spill_dir:
+                if old_key not in self.disk:
+                    self._spill(old_key, old_n, old_state)
+            else:
+                self._drop_key(old_n)
+
+    def _paths(self, key):
+        return os.path.join(self.spill_dir, key + '.bin'), os.path.join(self.spill_dir, key + '.json')
+
+    def _spill(self, key, n, state):
+        bin_path, meta_path = self._paths(key)
+        meta = {'length': n, 'is_list': isinstance(state, (list, tuple)), 'tensors': []}
+        with open(bin_path, 'wb') as f:
+            for t in _tensors(state):
+                meta['tensors'].append([str(t.dtype).replace('torch.', ''), list(t.shape), str(t.device)])
+                # raw bytes, so bf16 / fp16 states round-trip without numpy dtype support
+                f.write(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        # the .json is written last: a state is only visible once its .bin is complete
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        self.disk[key] = n
+
+    def _load(self, key):
+        bin_path, meta_path = self._paths(key)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        buf = np.memmap(bin_path, dtype=np.uint8, mode='r')
+        state = []
+        offset = 0
+        for dtype, shape, device in meta['tensors']:
+            dtype = getattr(torch, dtype)
+            size = int(np.prod(shape)) * torch.empty(0, dtype=dtype).element_size()
+            t = torch.from_numpy(np.array(buf[offset : offset + size])).view(dtype).reshape(shape)
+            if device.startswith('cuda') and not torch.cuda.is_available():
+                device = 'cpu'
+            state.append(t.to(device))
+            offset += size
+        del buf
+        return state if meta['is_list'] else state[0]
+
+    def lookup(self, tokens):
+        # returns (n, state) for the longest cached prefix tokens[:n], or (0, None)
+        # the state is a copy: the caller may advance it in place
+        for n in sorted(self.lengths, reverse=True):
+            if n > len(tokens):
+                continue
+            key = prefix_key(tokens[:n])
+            if key in self.mem:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                return n, _clone(self.mem[key][1])
+            if key in self.disk:
+                state = self._load(key)
+                self._insert(key, n, state)
+                self.hits += 1
+                return n, _clone(state)
+        self.misses += 1
+        return 0, None
+
+    def put(self, tokens, state):
+        key = prefix_key(tokens)
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            return
+        self._insert(key, len(tokens), _clone(state))
+
+    def __len__(self):
+        return len(set(self.mem) | set(self.disk))
@@ -4,6 +4,8 @@ from torch.utils.data import DataLoader
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_info, rank_zero_only
 from .model import LORA_CONFIG
+from .checkpoint import AsyncCheckpointWriter, make_storage
+from .resize import resize_tensor
 
 def my_save(dd, ff):
     if '14b-run1' not in ff:
@@ -18,6 +20,26 @@ class train_callback(pl.Callback):
     def __init__(self, args):
         super().__init__()
         self.args = args
+        self.ckpt_writer = None
+
+    def save(self, trainer, to_save_dict, ff, rotate=True):
+        args = self.args
+        if args.ckpt_async == 0:
+            my_save(to_save_dict, ff)
+            return
+        if self.ckpt_writer is None:
+            storage = make_storage(args.ckpt_storage, args.proj_dir)
+            staging_dir = args.ckpt_staging_dir or args.proj_dir
+            self.ckpt_writer = AsyncCheckpointWriter(storage, staging_dir, keep=args.ckpt_keep)
+        idle = self.ckpt_writer.save(to_save_dict, os.path.basename(ff), rotate=rotate)
+        print(f"\nCheckpoint {os.path.basename(ff)}: training blocked for {idle:.3f}s")
+        trainer.my_log.write(f"checkpoint {os.path.basename(ff)} blocked {idle:.3f}s\n")
+        if len(args.wandb) > 0:
+            trainer.my_wandb.log({"ckpt_blocked_s": idle}, step=int(trainer.global_step + args.epoch_begin * args.epoch_steps))
+
+    def on_train_end(self, trainer, pl_module):
+        if self.ckpt_writer is not None:
+            self.ckpt_writer.close()
 
     def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
         args = self.args
@@ -110,9 +132,11 @@ class train_callback(pl.Callback):
                 expand_factor = 2 if args.my_qa_mask > 0 else 1
                 if int(real_step) == int(args.magic_prime * expand_factor // args.real_bsz) - 1:
                     to_save_dict = pl_module.state_dict()
-                    my_save(
+                    self.save(
+                        trainer,
                         to_save_dict,
                         f"{args.proj_dir}/rwkv-final.pth",
+                        rotate=False,
                     )
 
 
@@ -150,7 +174,8 @@ class train_callback(pl.Callback):
                     to_save_dict = lora_dict
 
                 try:
-                    my_save(
+                    self.save(
+                        trainer,
                         to_save_dict,
                         f"{args.proj_dir}/rwkv-{args.epoch_begin + trainer.current_epoch}.pth",
                     )
@@ -177,19 +202,8 @@ def generate_init_weight(model, init_weight_name):
                 try:
                     mm[k] = src.reshape(mm[k].shape)
                 except:
-                    tmp = mm[k].squeeze().clone()
                     print(k, src.shape, '-->', mm[k].shape)
-                    ss = src.shape[0]
-                    dd = tmp.shape[0]
-                    for i in range(dd):
-                        pos = i / dd * ss
-                        if pos >= ss - 1:
-                            tmp[i] = src[ss-1]
-                        else:
-                            p0 = int(math.floor(pos))
-                            ii = pos - p0
-                            tmp[i] = src[p0] * (1-ii) + src[p0+1] * (ii)
-                    mm[k] = tmp.reshape(mm[k].shape)
+                    mm[k] = resize_tensor(src, mm[k].shape, device="cuda" if torch.cuda.is_available() else "cpu", dtype=mm[k].dtype).cpu()
                     sss = src.squeeze().float().cpu().numpy()
                     print(sss[:10], '...', sss[-10:])
                     mmm = mm[k].squeeze().float().cpu().numpy()
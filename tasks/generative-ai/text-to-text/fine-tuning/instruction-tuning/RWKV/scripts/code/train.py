@@ -106,6 +106,11 @@ if __name__ == "__main__":
     parser.add_argument("--magic_prime", default=0, type=int)
     parser.add_argument("--my_qa_mask", default=0, type=int)
     parser.add_argument("--my_testing", default='', type=str)
+    parser.add_argument("--data_batch_read", default=1, type=int)  # binidx: read each micro-batch from the memmap in one gather
+    parser.add_argument("--ckpt_async", default=1, type=int)  # write checkpoints on a background thread
+    parser.add_argument("--ckpt_keep", default=0, type=int)  # keep only the newest N epoch checkpoints (0 = all)
+    parser.add_argument("--ckpt_storage", default="", type=str)  # "" = proj_dir, another local dir, or s3://bucket/prefix
+    parser.add_argument("--ckpt_staging_dir", default="", type=str)  # where checkpoints are written before moving to ckpt_storage ("" = proj_dir)
 
     parser.add_argument("--lora", default=False, type=bool)
     parser.add_argument("--lora_load", default="", type=str)
@@ -375,6 +380,14 @@ if __name__ == "__main__":
         trainer.strategy.config["zero_optimization"]["reduce_bucket_size"] = args.ds_bucket_mb * 1000 * 1000
 
     # must set shuffle=False, persistent_workers=False (because worker is in another thread)
-    data_loader = DataLoader(train_data, shuffle=False, pin_memory=True, batch_size=args.micro_bsz, num_workers=1, persistent_workers=False, drop_last=True)
+    if args.data_type == "binidx" and args.data_batch_read > 0 and args.my_pile_stage == 0 and args.my_qa_mask == 0:
+        from src.dataset import WindowBatchSampler
+        sampler = WindowBatchSampler(
+            train_data.data_size, args.ctx_len + 1, args.micro_bsz, args.epoch_steps,
+            seed=None if args.random_seed < 0 else [args.random_seed, trainer.global_rank],
+        )
+        data_loader = DataLoader(train_data, sampler=sampler, shuffle=False, pin_memory=True, batch_size=None, num_workers=1, persistent_workers=False)
+    else:
+        data_loader = DataLoader(train_data, shuffle=False, pin_memory=True, batch_size=args.micro_bsz, num_workers=1, persistent_workers=False, drop_last=True)
 
     trainer.fit(model, data_loader)
\ No newline at end of file
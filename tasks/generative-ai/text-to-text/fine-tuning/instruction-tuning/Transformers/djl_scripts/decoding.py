@@ -0,0 +1,262 @@
+"""
+Continuous batching for Hugging Face causal LMs: a decode loop over the model's forward and
+past_key_values that admits new requests into free batch slots at every step and retires each
+sequence as soon as it hits a stop id or its own max_new_tokens.
+
+The same file is shipped as decoding.py next to the DJL handler (djl_scripts/); keep the two
+copies identical (tests/utils/test_decoding.py checks this).
+"""
+
+import inspect
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import torch
+
+
+def _to_layers(past) -> List[List[torch.Tensor]]:
+    # per-layer [key, value] tensors of shape (batch, heads, seq, head_dim), for tuple caches
+    # (transformers < 4.36) as well as Cache objects
+    if isinstance(past, (tuple, list)):
+        return [[k, v] for k, v in past]
+    if hasattr(past, "layers"):
+        return [[layer.keys, layer.values] for layer in past.layers]
+    return [[k, v] for k, v in zip(past.key_cache, past.value_cache)]
+
+
+def _from_layers(layers, cache_cls):
+    if cache_cls is None:
+        return tuple((k, v) for k, v in layers)
+    cache = cache_cls()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+
+def _accepts_position_ids(model) -> bool:
+    # look through torch.compile and PEFT wrappers, whose forward takes **kwargs
+    model = getattr(model, "_orig_mod", model)
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return "position_ids" in inspect.signature(model.forward).parameters
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if t.size(dim) >= length:
+        return t
+    shape = list(t.shape)
+    shape[dim] = length - t.size(dim)
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+
+def sample_next(logits: torch.Tensor, rows: Sequence["_Request"]) -> torch.Tensor:
+    # one token per row with each row's own do_sample / temperature / top_k / top_p
+    logits = logits.float()
+    tokens = logits.argmax(dim=-1)
+    sampled = [i for i, row in enumerate(rows) if row.do_sample and row.temperature > 0]
+    if not sampled:
+        return tokens
+    idx = torch.tensor(sampled, device=logits.device)
+    x = logits[idx] / torch.tensor([rows[i].temperature for i in sampled], device=logits.device).unsqueeze(1)
+    top_k = torch.tensor([rows[i].top_k or x.size(-1) for i in sampled], device=logits.device)
+    top_p = torch.tensor([rows[i].top_p for i in sampled], device=logits.device)
+
+    sorted_logits, sorted_idx = x.sort(dim=-1, descending=True)
+    probs = sorted_logits.softmax(dim=-1)
+    rank = torch.arange(x.size(-1), device=logits.device).unsqueeze(0)
+    # keep the top_k best, and the smallest prefix whose probability reaches top_p
+    remove = (rank >= top_k.unsqueeze(1)) | (probs.cumsum(dim=-1) - probs > top_p.unsqueeze(1))
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    choice = torch.multinomial(sorted_logits.softmax(dim=-1), 1)
+    tokens[idx] = sorted_idx.gather(1, choice).squeeze(1)
+    return tokens
+
+
+class _Request(object):
+    __slots__ = (
+        "input_ids", "future", "max_new_tokens", "stop_ids",
+        "do_sample", "temperature", "top_k", "top_p", "generated",
+    )
+
+    def __init__(self, input_ids: List[int], future: Future, max_new_tokens: int = 128,
+                 stop_ids: Sequence[int] = (), do_sample: bool = False, temperature: float = 1.0,
+                 top_k: int = 0, top_p: float = 1.0, **kwargs):
+        self.input_ids = input_ids
+        self.future = future
+        self.max_new_tokens = max_new_tokens
+        self.stop_ids = set(stop_ids)
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.generated: List[int] = []
+
+
+class DecodeMetrics(object):
+    """Counters for the decode loop; `snapshot()` gives rates since the previous snapshot."""
+
+    def __init__(self, max_batch_size: int):
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.steps = 0
+        self.tokens = 0  # one per active row per step, so tokens / steps is the mean batch size
+        self.finished = 0
+        self._last = (time.time(), 0, 0)
+
+    def record_step(self, active: int):
+        with self.lock:
+            self.steps += 1
+            self.tokens += active
+
+    def record_finished(self):
+        with self.lock:
+            self.finished += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            now = time.time()
+            t0, steps0, tokens0 = self._last
+            steps = self.steps - steps0
+            tokens = self.tokens - tokens0
+            self._last = (now, self.steps, self.tokens)
+            return {
+                "steps": self.steps,
+                "tokens": self.tokens,
+                "finished": self.finished,
+                "tokens_per_s": tokens / max(now - t0, 1e-9),
+                "steps_per_s": steps / max(now - t0, 1e-9),
+                "slot_occupancy": tokens / max(steps * self.max_batch_size, 1),
+            }
+
+
+class ContinuousBatcher(object):
+    """
+    Runs generation requests through a single decode loop with up to `max_batch_size` rows.
+    `submit` / `map` block until their own sequences finish, not until the whole batch does.
+    Per request it honours max_new_tokens, stop_ids, do_sample, temperature, top_k and top_p;
+    other generation kwargs are ignored. `log_every` prints DecodeMetrics every N steps.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, eos_token_id: Optional[int] = None,
+                 log_every: int = 0):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.eos_token_id = tokenizer.eos_token_id if eos_token_id is None else eos_token_id
+        self.log_every = log_every
+        self.device = next(model.parameters()).device
+        self.metrics = DecodeMetrics(max_batch_size)
+        self._use_position_ids = _accepts_position_ids(model)
+        self._cache_cls = None
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt: Union[str, List[int]], **kwargs) -> str:
+        return self.map([prompt], [kwargs])[0]
+
+    def map(self, prompts: Sequence[Union[str, List[int]]], kwargs_list: Sequence[Dict[str, Any]]) -> List[str]:
+        # prompts are strings or already tokenized ids
+        futures = []
+        for prompt, kwargs in zip(prompts, kwargs_list):
+            if isinstance(prompt, str):
+                input_ids = self.tokenizer(prompt, add_special_tokens=False, return_token_type_ids=False)["input_ids"]
+            else:
+                input_ids = list(prompt)
+            future: Future = Future()
+            self._queue.put(_Request(input_ids, future, **kwargs))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _forward(self, input_ids, attention_mask, layers):
+        kwargs = dict(input_ids=input_ids, attention_mask=attention_mask, use_cache=True)
+        if self._use_position_ids:
+            position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+            kwargs["position_ids"] = position_ids[:, -input_ids.size(1):]
+        if layers is not None:
+            kwargs["past_key_values"] = _from_layers(layers, self._cache_cls)
+        out = self.model(**kwargs)
+        past = out.past_key_values
+        if not isinstance(past, (tuple, list)):
+            self._cache_cls = type(past)
+        return out.logits[:, -1, :], _to_layers(past)
+
+    def _loop(self):
+        rows: List[_Request] = []
+        layers = None  # per-layer [key, value], left-padded to a common length
+        mask = None  # (rows, seq) attention mask over the cached positions
+        last = None  # (rows,) token to feed at the next step
+        step = 0
+
+        while True:
+            # admit: prefill waiting requests one by one into free slots
+            while len(rows) < self.max_batch_size:
+                try:
+                    seq = self._queue.get(block=not rows)
+                except queue.Empty:
+                    break
+                try:
+                    with torch.no_grad():
+                        ids = torch.tensor([seq.input_ids], device=self.device)
+                        logits, new_layers = self._forward(ids, torch.ones_like(ids), None)
+                        token = sample_next(logits, [seq])
+                except Exception as e:
+                    seq.future.set_exception(e)
+                    continue
+                new_mask = torch.ones_like(ids)
+                if rows:
+                    length = max(mask.size(1), new_mask.size(1))
+                    layers = [
+                        [torch.cat([_left_pad(a, length, 2), _left_pad(b, length, 2)]) for a, b in zip(old, new)]
+                        for old, new in zip(layers, new_layers)
+                    ]
+                    mask = torch.cat([_left_pad(mask, length, 1), _left_pad(new_mask, length, 1)])
+                    last = torch.cat([last, token])
+                else:
+                    layers, mask, last = new_layers, new_mask, token
+                rows.append(seq)
+            if not rows:
+                continue
+
+            # retire finished rows (the token in `last` is already part of their output)
+            keep = []
+            for i, (seq, token) in enumerate(zip(rows, last.tolist())):
+                seq.generated.append(token)
+                if token in seq.stop_ids or token == self.eos_token_id or len(seq.generated) >= seq.max_new_tokens:
+                    seq.future.set_result(self.tokenizer.decode(seq.generated, skip_special_tokens=True))
+                    self.metrics.record_finished()
+                else:
+                    keep.append(i)
+            if len(keep) < len(rows):
+                rows = [rows[i] for i in keep]
+                if not rows:
+                    layers = mask = last = None
+                    continue
+                idx = torch.tensor(keep, device=self.device)
+                layers = [[k.index_select(0, idx), v.index_select(0, idx)] for k, v in layers]
+                mask = mask.index_select(0, idx)
+                last = last.index_select(0, idx)
+                # drop cache columns that are padding for every remaining row
+                start = int((mask.sum(dim=0) > 0).nonzero()[0])
+                if start > 0:
+                    layers = [[k[:, :, start:], v[:, :, start:]] for k, v in layers]
+                    mask = mask[:, start:]
+
+            # decode one token for every active row
+            mask = torch.cat([mask, mask.new_ones(len(rows), 1)], dim=1)
+            try:
+                with torch.no_grad():
+                    logits, layers = self._forward(last.unsqueeze(1), mask, layers)
+                    last = sample_next(logits, rows)
+            except Exception as e:
+                for seq in rows:
+                    seq.future.set_exception(e)
+                rows, layers, mask, last = [], None, None, None
+                continue
+            self.metrics.record_step(len(rows))
+            step += 1
+            if self.log_every > 0 and step % self.log_every == 0:
+                print("Decode metrics:", self.metrics.snapshot())
@@ -1,14 +1,22 @@
 from djl_python import Input, Output
 import os
+import fcntl
+import hashlib
+import shutil
 import torch
 from peft import PeftModel
 from transformers import GenerationConfig, AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, BitsAndBytesConfig
-from typing import Any, Dict, Tuple, Union, Optional
+from typing import Any, Dict, List, Tuple, Union, Optional
 import warnings
 
+from decoding import ContinuousBatcher
+from prompt_tokenizer import PromptTokenizer
+
 model = None
 tokenizer = None
 prompter = None
+prompt_tokenizer = None
+batcher = None
 
 
 class StopOnTokens(StoppingCriteria):
@@ -45,8 +53,87 @@ class Prompter(object):
                 instruction=instruction
             )
         return res
-    
-    
+
+
+def _flag(properties, name, default=False):
+    # serving.properties values arrive as strings
+    value = properties.get(name, default)
+    return value if isinstance(value, bool) else str(value).lower() == "true"
+
+
+def _file_fingerprint(file, full=True, block=1 << 20, samples=16):
+    # sha256 of the file size and its whole contents; full=False hashes only `samples` evenly
+    # spaced blocks instead. Same scheme as _fingerprint in RWKV/scripts/code/src/lora_merge.py.
+    h = hashlib.sha256()
+    size = os.path.getsize(file)
+    h.update(str(size).encode())
+    with open(file, "rb") as fp:
+        if full or size <= block * samples:
+            while True:
+                chunk = fp.read(block * 16)
+                if not chunk:
+                    break
+                h.update(chunk)
+        else:
+            for i in range(samples):
+                fp.seek((size - block) * i // (samples - 1))
+                h.update(fp.read(block))
+    return h.hexdigest()
+
+
+def _fingerprint(path, full=True):
+    # hash of every file name and _file_fingerprint under path, so two base models or adapters
+    # with the same layout but different weights get different keys; a hub id is hashed by name
+    h = hashlib.sha256(path.encode())
+    if not os.path.exists(path):
+        return h.hexdigest()
+    files = [path] if os.path.isfile(path) else sorted(
+        os.path.join(root, f) for root, _, names in os.walk(path) for f in names
+    )
+    for file in files:
+        h.update(f"{os.path.relpath(file, path)}:{_file_fingerprint(file, full)}".encode())
+    return h.hexdigest()
+
+
+def merged_model_dir(model_name, lora_weights, cache_root):
+    # directory with the LoRA merged into the fp16 base as safetensors, keyed by model and
+    # adapter hash; built once, then every later worker start loads it directly
+    key = hashlib.sha256(f"{_fingerprint(model_name)}:{_fingerprint(lora_weights)}".encode()).hexdigest()[:32]
+    path = os.path.join(cache_root, f"merged-{key}")
+    if os.path.exists(os.path.join(path, "config.json")):
+        print("Using cached merged model: ", path)
+        return path
+
+    os.makedirs(cache_root, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        # workers starting together wait for the first one to finish the merge
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(path, "config.json")):
+            return path
+        print("Merging Lora Weight into: ", path)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            cache_dir="/tmp/model_cache/",
+            trust_remote_code=True,
+        )
+        model = PeftModel.from_pretrained(
+            model,
+            lora_weights,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        ).merge_and_unload()
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        model.save_pretrained(tmp, safe_serialization=True)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp)
+        os.rename(tmp, path)
+        del model
+        torch.cuda.empty_cache()
+    return path
+
+
 def get_model(properties):
     # Get Properties
     print(properties)
@@ -54,9 +141,18 @@ def get_model(properties):
     prompt_input = properties.get("prompt_input", "")
     prompt_no_input = properties.get("prompt_no_input", "")
     lora_weights = properties.get("lora_weights", "")
-    load_8bit = properties.get("load_8bit", False)
-    load_4bit = properties.get("load_4bit", False)
-    
+    load_8bit = _flag(properties, "load_8bit")
+    load_4bit = _flag(properties, "load_4bit")
+    # merge_lora=true loads a merged fp16 copy from merged_cache_dir (building it on the first
+    # start); 8/4-bit quantization is then applied to the merged weights at load time
+    merge_lora = _flag(properties, "merge_lora")
+    merged_cache_dir = properties.get("merged_cache_dir", "/tmp/merged_model_cache/")
+
+    tokenizer_name = model_name
+    if lora_weights and merge_lora:
+        model_name = tokenizer_name = merged_model_dir(model_name, lora_weights, merged_cache_dir)
+        lora_weights = ""
+
     if load_4bit:
         nf4_config = BitsAndBytesConfig(
             load_in_4bit=True,
@@ -88,44 +184,83 @@ def get_model(properties):
             torch_dtype=torch.float16,
             device_map="auto",
         )
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
     prompter = Prompter(prompt_input, prompt_no_input)
     return model, tokenizer, prompter
 
 
+def warmup(model, tokenizer):
+    # one short generate so CUDA init and kernel selection happen before the first request
+    inputs = tokenizer("Hello", add_special_tokens=False, return_token_type_ids=False, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=1)
+
+
+def get_prompt_ids(data):
+    instruction = data["instruction"]
+    input = data["input"]
+    if instruction != "":
+        return prompt_tokenizer.encode(instruction, input)
+    return prompt_tokenizer.encode_text(input)
+
+
 def handle(inputs: Input) -> Optional[Output]:
     global model
     global tokenizer
     global prompter
+    global prompt_tokenizer
+    global batcher
     
     if not model:
         try:
-            model, tokenizer, prompter = get_model(inputs.get_properties())
+            properties = inputs.get_properties()
+            model, tokenizer, prompter = get_model(properties)
+            prompt_tokenizer = PromptTokenizer(prompter, tokenizer)
+            # continuous_batching=true decodes up to max_batch_size requests in one loop that
+            # admits and retires sequences at every step (set batch_size in serving.properties
+            # so DJL hands several requests to one call)
+            if str(properties.get("continuous_batching", "false")).lower() == "true":
+                batcher = ContinuousBatcher(
+                    model,
+                    tokenizer,
+                    max_batch_size=int(properties.get("max_batch_size", 8)),
+                    log_every=int(properties.get("metrics_every", 100)),
+                )
+            warmup(model, tokenizer)
         except Exception as e:
-            print(e)
+            # fail the worker instead of answering every request with a half-loaded model
+            print("Model error:", e)
+            model = None
+            raise
             
     if inputs.is_empty():
         # Model server makes an empty call to warmup the model on startup
         return None
-    
+
+    if batcher is not None:
+        batch = inputs.get_batches() if inputs.is_batch() else [inputs]
+        requests = [item.get_as_json() for item in batch]
+        results = batcher.map(
+            [get_prompt_ids(data) for data in requests],
+            [dict(data["properties"], stop_ids=data.get("stop_ids", [])) for data in requests],
+        )
+        if not inputs.is_batch():
+            return Output().add_as_json(results[0])
+        outputs = Output()
+        for i, result in enumerate(results):
+            outputs.add_as_json(result, batch_index=i)
+        return outputs
+
     data = inputs.get_as_json()
-    instruction = data["instruction"]
-    input = data["input"]
-    if instruction != "":
-        prompt = prompter.generate_prompt(instruction, input)
-    else:
-        prompt = input
-    print(prompt)
+    prompt_ids = get_prompt_ids(data)
     
     generation_kwargs = data["properties"]
     stop_ids = data.get("stop_ids", [])
     
-    inputs = tokenizer(
-        prompt, 
-        add_special_tokens=False,
-        return_token_type_ids=False,
-        return_tensors="pt"
-    ).to(model.device)
+    inputs = {
+        "input_ids": torch.tensor([prompt_ids], device=model.device),
+        "attention_mask": torch.ones(1, len(prompt_ids), dtype=torch.long, device=model.device),
+    }
     generation_config = GenerationConfig(
         return_dict_in_generate=True,
         output_scores=True,
@@ -2,13 +2,14 @@
 
 import os
 import sys
+import json
 import subprocess
 from typing import List, Dict
 
 import fire
 import torch
 import transformers
-from datasets import load_dataset
+from datasets import Dataset, load_dataset
 
 """
 Unused imports:
@@ -28,6 +29,9 @@ from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 from transformers.trainer_callback import TrainerCallback
 
 from utils.prompter import Prompter
+from utils.packing import PackedDataCollator, pack_examples, packing_report
+from utils.preprocessing import cached_map, make_tokenize_function, tokenizer_fingerprint
+from utils.bucketing import BucketingTrainer, ThroughputTrainer, bucketing_report, dataset_lengths
 
 class SavePeftModelCallback(TrainerCallback):
     def on_save(self, args, state, control, **kwargs):
@@ -73,8 +77,11 @@ def train(
     use_gradient_checkpointing=True,
     # llm hyperparams
     train_on_inputs: bool = True,  # if False, masks out inputs in loss
-    add_eos_token: bool = False,
+    add_eos_token: bool = False,  # no effect: the full prompt always ends with eos (kept for existing launch scripts)
     group_by_length: bool = False,  # faster, but produces an odd training loss curve
+    packing: bool = False,  # pack examples into cutoff_len sequences instead of padding each batch
+    bucket_batches: bool = False,  # batch examples of similar length together (shuffled across buckets)
+    max_tokens_per_batch: int = 0,  # with bucket_batches: token budget per batch instead of a fixed batch size
     # wandb params
     wandb_project: str = "",
     wandb_run_name: str = "",
@@ -82,6 +89,8 @@ def train(
     wandb_log_model: str = "",  # options: false | true
     resume_from_checkpoint: str = None,  # either training checkpoint or final adapter
     prompt_template_name: str = "alpaca",  # The prompt template to use, will default to alpaca.
+    preprocessing_num_workers: int = 0,  # tokenizer processes, 0 = one per CPU (up to 8)
+    preprocessing_cache_dir: str = "/tmp/preprocessed_cache/",  # tokenized datasets, reused across runs
 ):
     if int(os.environ.get("LOCAL_RANK", 0)) == 0:
         print(
@@ -102,6 +111,8 @@ def train(
             f"train_on_inputs: {train_on_inputs}\n"
             f"add_eos_token: {add_eos_token}\n"
             f"group_by_length: {group_by_length}\n"
+            f"packing: {packing}\n"
+            f"bucket_batches: {bucket_batches}\n"
             f"wandb_project: {wandb_project}\n"
             f"wandb_run_name: {wandb_run_name}\n"
             f"wandb_watch: {wandb_watch}\n"
@@ -178,47 +189,19 @@ def train(
         tokenizer.pad_token_id != tokenizer.eos_token_id
     ), "Please set pad_token_id which is different from eos_token_id "
 
-    def tokenize(prompt, add_eos_token=True):
-        # there's probably a way to do this with the tokenizer settings
-        # but again, gotta move fast
-        result = tokenizer(
-            prompt,
+    tokenize_batch = make_tokenize_function(tokenizer, prompter, train_on_inputs)
+    tokenize_cache_key = [prompter.template, tokenizer_fingerprint(tokenizer), train_on_inputs]
+
+    def generate_and_tokenize(dataset):
+        # tokenized in batches across worker processes; cached on disk by dataset fingerprint,
+        # template and tokenizer, so re-runs skip tokenization
+        return cached_map(
+            dataset,
+            tokenize_batch,
+            preprocessing_cache_dir,
+            tokenize_cache_key,
+            num_proc=preprocessing_num_workers or min(8, os.cpu_count() or 1),
         )
-        if (
-            result["input_ids"][-1] != tokenizer.eos_token_id
-            and add_eos_token
-        ):
-            result["input_ids"].append(tokenizer.eos_token_id)
-            result["attention_mask"].append(1)
-
-        return {
-            "input_ids": result["input_ids"],
-            "attention_mask": result["attention_mask"],
-        }
-
-    def generate_and_tokenize_prompt(data_point):
-        full_prompt = prompter.generate_prompt(
-            data_point["instruction"],
-            data_point["input"],
-            data_point["output"],
-        )
-        tokenized_full_prompt = tokenize(full_prompt)
-        if not train_on_inputs:
-            user_prompt = prompter.generate_prompt(
-                data_point["instruction"], data_point["input"]
-            )
-            tokenized_user_prompt = tokenize(user_prompt, add_eos_token=add_eos_token)
-            user_prompt_len = len(tokenized_user_prompt["input_ids"])
-
-            if add_eos_token:
-                user_prompt_len -= 1
-
-            tokenized_full_prompt["labels"] = [
-                -100
-            ] * user_prompt_len + tokenized_full_prompt["labels"][
-                user_prompt_len:
-            ]  # could be sped up, probably
-        return tokenized_full_prompt
 
     if load_in_4bit or load_in_8bit:
         model = prepare_model_for_kbit_training(
@@ -267,14 +250,10 @@ def train(
         train_val = data["train"].train_test_split(
             test_size=val_set_size, shuffle=True, seed=42
         )
-        train_data = (
-            train_val["train"].shuffle().map(generate_and_tokenize_prompt)
-        )
-        val_data = (
-            train_val["test"].shuffle().map(generate_and_tokenize_prompt)
-        )
+        train_data = generate_and_tokenize(train_val["train"]).shuffle()
+        val_data = generate_and_tokenize(train_val["test"]).shuffle()
     else:
-        train_data = data["train"].shuffle().map(generate_and_tokenize_prompt)
+        train_data = generate_and_tokenize(data["train"]).shuffle()
         val_data = None
     
     # Remove rows exceeding cutoff length
@@ -283,12 +262,42 @@ def train(
     val_data = val_data.filter(lambda x: len(x['input_ids']) < cutoff_len)
     print("Dataset Size After Filter: ", train_data.shape, val_data.shape)
 
+    if train_on_inputs:
+        data_collator = transformers.DataCollatorForLanguageModeling(tokenizer, mlm=False)
+    else:
+        # keeps the -100 labels of the user prompt, which DataCollatorForLanguageModeling overwrites
+        data_collator = transformers.DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True)
+
+    def pack(dataset):
+        labels = dataset["labels"] if "labels" in dataset.column_names else dataset["input_ids"]
+        return Dataset.from_dict(pack_examples({"input_ids": dataset["input_ids"], "labels": labels}, cutoff_len))
+
+    if packing:
+        # first-fit-decreasing packing into cutoff_len sequences; labels keep their -100 masking
+        lengths = [len(ids) for ids in train_data["input_ids"]]
+        train_data = pack(train_data)
+        if val_data is not None:
+            val_data = pack(val_data)
+        # flash_attention_2 separates the packed examples by position_ids; eager / sdpa need
+        # the block-diagonal mask to keep them from attending to each other
+        attn_implementation = getattr(model.config, "_attn_implementation", None)
+        data_collator = PackedDataCollator(
+            tokenizer.pad_token_id, block_diagonal_mask=attn_implementation != "flash_attention_2"
+        )
+
     if not ddp and torch.cuda.device_count() > 1:
         # keeps Trainer from trying its own DataParallelism when more than 1 gpu is available
         model.is_parallelizable = True
         model.model_parallel = True
 
-    trainer = transformers.Trainer(
+    # logs tokens_per_second, to compare runs with and without bucket_batches / packing
+    trainer_cls = ThroughputTrainer
+    trainer_kwargs = {}
+    if bucket_batches:
+        trainer_cls = BucketingTrainer
+        trainer_kwargs["max_tokens_per_batch"] = max_tokens_per_batch
+
+    trainer = trainer_cls(
         model=model,
         train_dataset=train_data,
         eval_dataset=val_data,
@@ -314,9 +323,29 @@ def train(
             report_to="wandb" if use_wandb else None,
             run_name=wandb_run_name if use_wandb else None,
         ),
-        data_collator=transformers.DataCollatorForLanguageModeling(tokenizer, mlm=False),
-        callbacks=[SavePeftModelCallback]
+        data_collator=data_collator,
+        callbacks=[SavePeftModelCallback],
+        **trainer_kwargs,
     )
+    if packing:
+        # with the batch size the Trainer actually uses (micro_batch_size is not passed to it)
+        report = packing_report(
+            lengths, [len(ids) for ids in train_data["input_ids"]], trainer.args.per_device_train_batch_size
+        )
+        print("Packing report: ", report)
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, "packing_report.json"), "w") as fp:
+                json.dump(report, fp, indent=2)
+    if bucket_batches:
+        report = bucketing_report(
+            dataset_lengths(train_data), trainer.args.per_device_train_batch_size, max_tokens_per_batch
+        )
+        print("Bucketing report: ", report)
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, "bucketing_report.json"), "w") as fp:
+                json.dump(report, fp, indent=2)
     model.config.use_cache = False
 
     trainer.train(resume_from_checkpoint=resume_from_checkpoint)
@@ -9,18 +9,27 @@ from peft import PeftModel
 from transformers import GenerationConfig, AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList, BitsAndBytesConfig
 import deepspeed
 
-from utils.prompter import Prompter
+from utils.prompter import Prompter, PromptTokenizer
+from utils.batching import RequestBatcher, group_requests, trim_at_stop
+from utils.decoding import ContinuousBatcher
 
 
 class StopOnTokens(StoppingCriteria):
+    # stop_ids is either one list shared by every row or one list per row; generation
+    # stops once every row has produced one of its stop ids
     def __init__(self, stop_ids):
-        self.stop_ids = stop_ids
+        if stop_ids and isinstance(stop_ids[0], (list, tuple)):
+            width = max(len(ids) for ids in stop_ids)
+            self.stop_ids = torch.tensor([list(ids) + [-1] * (width - len(ids)) for ids in stop_ids], dtype=torch.long)
+        else:
+            self.stop_ids = torch.tensor([list(stop_ids)], dtype=torch.long).view(1, -1)
+        self.done = None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for stop_id in self.stop_ids:
-            if input_ids[0][-1] == stop_id:
-                return True
-        return False
+        stop_ids = self.stop_ids.to(input_ids.device)
+        hit = (input_ids[:, -1:] == stop_ids).any(dim=1)
+        self.done = hit if self.done is None else self.done | hit
+        return bool(self.done.all())
 
 
 def main(
@@ -49,6 +58,9 @@ def main(
 
     prompter = Prompter(prompt_template)
     tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, **tokenizer_kwargs)
+    tokenizer.padding_side = "left"  # batched requests are left-padded so generation continues each prompt
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
     print("Loading Model: ", base_model)
     if device == "cuda":
@@ -116,7 +128,10 @@ def main(
             model = model.to_bettertransformer()
         model = torch.compile(model)
 
-    return device, prompter, tokenizer, model
+    # the prompt template's static parts are tokenized once, not per request
+    prompt_tokenizer = PromptTokenizer(prompter, tokenizer)
+
+    return device, prompt_tokenizer, tokenizer, model
 
 
 def evaluate(
@@ -127,35 +142,65 @@ def evaluate(
     stop_ids=[],
     **kwargs,
 ):
-    device, prompter, tokenizer, model = model_objects
+    return evaluate_batch(
+        model_objects,
+        [dict(instruction=instruction, input=input, max_new_tokens=max_new_tokens, stop_ids=stop_ids, **kwargs)],
+    )[0]
 
-    # Generate Prompt when there are instruction, otherwise use input
-    if instruction != "":
-        prompt = prompter.generate_prompt(instruction, input)
-    else:
-        prompt = input
-    inputs = tokenizer(
-        prompt, 
-        add_special_tokens=False,
-        return_token_type_ids=False,
-        return_tensors="pt"
-    ).to(device)
-
-    generation_config = GenerationConfig(
-        max_new_tokens=max_new_tokens,
-        return_dict_in_generate=True,
-        output_scores=True,
-        **kwargs,
-    )
-    with torch.no_grad():
-        generation_output = model.generate(
-            **inputs,
-            generation_config=generation_config,
-            stopping_criteria=StoppingCriteriaList([StopOnTokens(stop_ids)]),
+
+def evaluate_batch(
+    model_objects,
+    requests,
+):
+    # requests with the same generation kwargs share one left-padded `generate` call;
+    # each row is cut at its own stop id and max_new_tokens
+    device, prompt_tokenizer, tokenizer, model = model_objects
+    prompt_ids = []
+    for row in requests:
+        # Generate Prompt when there are instruction, otherwise use input
+        if row.get("instruction") != "":
+            prompt_ids.append(prompt_tokenizer.encode(row.get("instruction"), row.get("input")))
+        else:
+            prompt_ids.append(prompt_tokenizer.encode_text(row.get("input")))
+
+    if isinstance(model, ContinuousBatcher):
+        return model.map(
+            prompt_ids,
+            [{k: v for k, v in row.items() if k not in ("instruction", "input")} for row in requests],
+        )
+
+    outputs = [None] * len(requests)
+    for group in group_requests(requests):
+        rows = [requests[i] for i in group]
+        inputs = tokenizer.pad(
+            {"input_ids": [prompt_ids[i] for i in group]},
+            padding=True,
+            return_tensors="pt"
+        ).to(device)
+
+        max_new_tokens = [row.get("max_new_tokens", 128) for row in rows]
+        stop_ids = [row.get("stop_ids", []) for row in rows]
+        kwargs = {
+            k: v for k, v in rows[0].items()
+            if k not in ("instruction", "input", "max_new_tokens", "stop_ids")
+        }
+        generation_config = GenerationConfig(
+            max_new_tokens=max(max_new_tokens),
+            return_dict_in_generate=True,
+            output_scores=True,
+            **kwargs,
         )
-    s = generation_output.sequences[0, inputs['input_ids'].size(1):]
-    output = tokenizer.decode(s, skip_special_tokens=True)
-    return output
+        with torch.no_grad():
+            generation_output = model.generate(
+                **inputs,
+                generation_config=generation_config,
+                stopping_criteria=StoppingCriteriaList([StopOnTokens(stop_ids)]),
+            )
+        sequences = generation_output.sequences[:, inputs['input_ids'].size(1):].tolist()
+        for i, s, row_stop_ids, row_max_new_tokens in zip(group, sequences, stop_ids, max_new_tokens):
+            s = trim_at_stop(s, row_stop_ids, row_max_new_tokens)
+            outputs[i] = tokenizer.decode(s, skip_special_tokens=True)
+    return outputs
 
 
 def model_fn(
@@ -163,10 +208,33 @@ def model_fn(
 ):
     model_params = json.loads(os.environ['model_params'])
     print(model_params)
+    # max_batch_size > 1 queues concurrent predict_fn calls and runs up to that many
+    # per `generate`; requests arriving within batch_wait_ms of the first one share its batch
+    # (batch_wait_ms=0 runs every request at once). Clients can also send a list of requests,
+    # which runs as one batch (see RequestBatcher)
+    # continuous_batching instead decodes up to max_batch_size sequences in one loop that
+    # admits new requests and retires finished ones at every step
+    max_batch_size = model_params.pop("max_batch_size", None)
+    batch_wait_ms = model_params.pop("batch_wait_ms", 10)
+    continuous_batching = model_params.pop("continuous_batching", False)
+    metrics_every = model_params.pop("metrics_every", 100)
     try:
-        return main(**model_params)
+        model_objects = main(**model_params)
     except Exception as e:
         print("Model error:", e)
+        return None
+    if continuous_batching:
+        device, prompt_tokenizer, tokenizer, model = model_objects
+        batcher = ContinuousBatcher(model, tokenizer, max_batch_size=max_batch_size or 8, log_every=metrics_every)
+        return device, prompt_tokenizer, tokenizer, batcher
+    if max_batch_size and max_batch_size > 1:
+        return RequestBatcher(
+            lambda requests: evaluate_batch(model_objects, requests),
+            max_batch_size=max_batch_size,
+            max_wait_ms=batch_wait_ms,
+            metrics_every=metrics_every,
+        )
+    return model_objects
 
 
 def input_fn(input_data, content_type):
@@ -183,6 +251,12 @@ def predict_fn(
     print("Predict Fn")
     print(data)
     try:
+        if isinstance(model, RequestBatcher):
+            if isinstance(data, list):
+                return model.map(data)
+            return model.submit(data)
+        if isinstance(data, list):
+            return evaluate_batch(model, data)
         return evaluate(
             model_objects=model,
             **data
@@ -41,6 +41,7 @@ from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
+    DataCollatorForSeq2Seq,
     HfArgumentParser,
     Trainer,
     TrainingArguments,
@@ -54,6 +55,7 @@ from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
 from utils.prompter import Prompter
+from utils.bucketing import BucketingTrainer, bucketing_report, dataset_lengths
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 # check_min_version("4.29.0.dev0")
@@ -258,6 +260,25 @@ class PrompterArguments:
         },
     )
 
+    bucket_batches: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": (
+                "Keep examples separate instead of concatenating them into block_size chunks, "
+                "and batch examples of similar length together"
+            )
+        },
+    )
+
+    max_tokens_per_batch: Optional[int] = field(
+        default=0,
+        metadata={
+            "help": (
+                "With bucket_batches: token budget per batch instead of a fixed batch size (0 = off)"
+            )
+        },
+    )
+
     
 def main():
     # See all possible arguments in src/transformers/training_args.py
@@ -590,7 +611,11 @@ def main():
     # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
 
     with training_args.main_process_first(desc="grouping texts together"):
-        if not data_args.streaming:
+        if prompter_args.bucket_batches:
+            # examples stay separate; DataCollatorForSeq2Seq pads each bucketed batch
+            assert not data_args.streaming, "bucket_batches needs a map-style (non-streaming) dataset"
+            lm_datasets = tokenized_datasets
+        elif not data_args.streaming:
             lm_datasets = tokenized_datasets.map(
                 group_texts,
                 batched=True,
@@ -637,19 +662,34 @@ def main():
             preds = preds[:, :-1].reshape(-1)
             return metric.compute(predictions=preds, references=labels)
 
+    trainer_cls = Trainer
+    trainer_kwargs = {}
+    data_collator = default_data_collator
+    if prompter_args.bucket_batches:
+        trainer_cls = BucketingTrainer
+        trainer_kwargs["max_tokens_per_batch"] = prompter_args.max_tokens_per_batch
+        data_collator = DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True)
+        if training_args.do_train:
+            report = bucketing_report(
+                dataset_lengths(train_dataset), training_args.per_device_train_batch_size,
+                prompter_args.max_tokens_per_batch,
+            )
+            logger.info(f"Bucketing report: {report}")
+
     # Initialize our Trainer
-    trainer = Trainer(
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
         eval_dataset=eval_dataset if training_args.do_eval else None,
         tokenizer=tokenizer,
         # Data collator will default to DataCollatorWithPadding, so we change it.
-        data_collator=default_data_collator,
+        data_collator=data_collator,
         compute_metrics=compute_metrics if training_args.do_eval and not is_torch_tpu_available() else None,
         preprocess_logits_for_metrics=preprocess_logits_for_metrics
         if training_args.do_eval and not is_torch_tpu_available()
         else None,
+        **trainer_kwargs,
     )
 
     # Training
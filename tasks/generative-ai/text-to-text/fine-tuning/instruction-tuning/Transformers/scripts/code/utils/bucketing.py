@@ -0,0 +1,198 @@
+"""
+Length-bucketed batching for instruction fine-tuning with the Hugging Face Trainer.
+"""
+
+import random
+import time
+from typing import Dict, Iterator, List, Sequence
+
+import datasets
+import transformers
+from torch.utils.data import DataLoader
+
+
+class LengthBucketBatchSampler(object):
+    """
+    Yields batches of dataset indices with similar lengths: the shuffled indices are cut into
+    buckets of `batch_size * bucket_batches` examples, each bucket is sorted by length and split
+    into batches, and the batches of all buckets are shuffled together. With `max_tokens` a batch
+    instead grows while `len(batch) * longest <= max_tokens`; those batches are grouped once and
+    only their order changes between epochs, since regrouping would change how many there are
+    (and `len()`, which the Trainer plans its steps and LR schedule from). With
+    `num_replicas > 1` every rank gets the same number of batches.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        max_tokens: int = 0,
+        bucket_batches: int = 50,
+        shuffle: bool = True,
+        seed: int = 42,
+        num_replicas: int = 1,
+        rank: int = 0,
+        drop_last: bool = False,
+    ):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split(self, bucket: List[int]) -> List[List[int]]:
+        if self.max_tokens <= 0:
+            return [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        batches, batch, longest = [], [], 0
+        for i in bucket:
+            longest_with = max(longest, self.lengths[i])
+            if batch and (len(batch) + 1) * longest_with > self.max_tokens:
+                batches.append(batch)
+                batch, longest_with = [], self.lengths[i]
+            batch.append(i)
+            longest = longest_with
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self, epoch: int) -> List[List[int]]:
+        if self._cache is not None and self._cache[0] == epoch:
+            return self._cache[1]
+        rng = random.Random(self.seed + epoch)
+        group_rng = random.Random(self.seed) if self.max_tokens > 0 else rng
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            group_rng.shuffle(indices)
+        size = self.batch_size * self.bucket_batches
+        batches = []
+        for s in range(0, len(indices), size):
+            batches.extend(self._split(sorted(indices[s:s + size], key=self.lengths.__getitem__)))
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            if self.drop_last:
+                batches = batches[:len(batches) - len(batches) % self.num_replicas]
+            else:
+                batches += batches[:-len(batches) % self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        self._cache = (epoch, batches)
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # advances the epoch itself, for callers that never call set_epoch
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self.batches(self.epoch))
+
+
+def bucketing_report(lengths: Sequence[int], batch_size: int, max_tokens: int = 0, seed: int = 42) -> Dict[str, float]:
+    # padded tokens per epoch for shuffled fixed-size batches vs the bucketed batches, computed
+    # from the lengths; the measured throughput is logged by ThroughputTrainer
+    shuffled = list(lengths)
+    random.Random(seed).shuffle(shuffled)
+    batches = LengthBucketBatchSampler(lengths, batch_size, max_tokens, seed=seed).batches(0)
+    random_tokens = sum(
+        max(shuffled[s:s + batch_size]) * len(shuffled[s:s + batch_size])
+        for s in range(0, len(shuffled), batch_size)
+    )
+    bucketed_tokens = sum(max(lengths[i] for i in b) * len(b) for b in batches)
+    return {
+        "examples": len(lengths),
+        "tokens": sum(lengths),
+        "padding_efficiency_random": sum(lengths) / max(random_tokens, 1),
+        "padding_efficiency_bucketed": sum(lengths) / max(bucketed_tokens, 1),
+        "padded_tokens_random": random_tokens,
+        "padded_tokens_bucketed": bucketed_tokens,
+        "compute_reduction": random_tokens / max(bucketed_tokens, 1),
+        "steps_random": -(-len(lengths) // batch_size),
+        "steps_bucketed": len(batches),
+    }
+
+
+def dataset_lengths(dataset) -> List[int]:
+    # the `length` column recorded at tokenization, or the input_ids lengths
+    if "length" in dataset.column_names:
+        return list(dataset["length"])
+    return [len(ids) for ids in dataset["input_ids"]]
+
+
+class ThroughputTrainer(transformers.Trainer):
+    """
+    Trainer that adds the measured training throughput to its logs: `tokens_per_second`
+    (tokens under a 2D attention_mask, or all tokens) and `padded_tokens_per_second` (tokens
+    computed, padding included), since the first training step on this process. Compare runs
+    with and without bucketing / packing with these.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._throughput_start = None
+        self._tokens = 0
+        self._padded_tokens = 0
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self._throughput_start is None:
+            self._throughput_start = time.monotonic()
+        input_ids = inputs["input_ids"]
+        mask = inputs.get("attention_mask")
+        self._padded_tokens += input_ids.numel()
+        self._tokens += int(mask.sum()) if mask is not None and mask.dim() == 2 else input_ids.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs: Dict[str, float], *args, **kwargs):
+        if self._throughput_start is not None and "loss" in logs:
+            elapsed = max(time.monotonic() - self._throughput_start, 1e-9)
+            logs["tokens_per_second"] = self._tokens / elapsed
+            logs["padded_tokens_per_second"] = self._padded_tokens / elapsed
+        super().log(logs, *args, **kwargs)
+
+
+class BucketingTrainer(ThroughputTrainer):
+    """
+    Trainer whose training dataloader uses LengthBucketBatchSampler; `max_tokens_per_batch`
+    switches from the per-device batch size to a per-batch token budget.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+
+    def get_train_dataloader(self) -> DataLoader:
+        train_dataset = self.train_dataset
+        lengths = dataset_lengths(train_dataset)
+        if isinstance(train_dataset, datasets.Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+
+        # with accelerate (newer Trainer) the prepared dataloader shards the batches across
+        # processes; otherwise every rank takes its own share here
+        accelerator = getattr(self, "accelerator", None)
+        shard = accelerator is None and self.args.world_size > 1
+        sampler = LengthBucketBatchSampler(
+            lengths,
+            self._train_batch_size,
+            max_tokens=self.max_tokens_per_batch,
+            seed=self.args.seed,
+            num_replicas=self.args.world_size if shard else 1,
+            rank=self.args.process_index if shard else 0,
+            drop_last=self.args.dataloader_drop_last,
+        )
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return accelerator.prepare(dataloader) if accelerator is not None else dataloader
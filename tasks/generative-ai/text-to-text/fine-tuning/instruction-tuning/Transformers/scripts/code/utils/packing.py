@@ -0,0 +1,133 @@
+"""
+Packs tokenized instruction examples into fixed-length training sequences.
+"""
+
+import random
+from typing import Dict, List, Sequence
+
+import torch
+
+
+def pack_ffd(lengths: Sequence[int], max_len: int) -> List[List[int]]:
+    # first-fit-decreasing bin packing; returns the example indices of each bin.
+    # A max segment tree over the bins' free space finds the first bin that fits in O(log n).
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    size = 1
+    while size < max(len(lengths), 1):
+        size *= 2
+    free = [0] * (2 * size)  # leaves are bins, unopened bins have 0 free space
+    bins: List[List[int]] = []
+
+    for i in order:
+        length = lengths[i]
+        assert length <= max_len, f"example {i} is longer than max_len ({length} > {max_len})"
+        if free[1] >= length:
+            node = 1
+            while node < size:
+                node = 2 * node if free[2 * node] >= length else 2 * node + 1
+            b = node - size
+        else:
+            b = len(bins)
+            bins.append([])
+            node = b + size
+            free[node] = max_len
+        bins[b].append(i)
+        free[node] -= length
+        node //= 2
+        while node:
+            free[node] = max(free[2 * node], free[2 * node + 1])
+            node //= 2
+    return bins
+
+
+def pack_examples(examples: Dict[str, List[List[int]]], max_len: int) -> Dict[str, List[List[int]]]:
+    # concatenates the examples of each FFD bin; position_ids restart at 0 for every example
+    # (PackedDataCollator derives the block-diagonal attention from them), and the first label
+    # of each example is -100 so no token is trained to predict across an example boundary
+    bins = pack_ffd([len(ids) for ids in examples["input_ids"]], max_len)
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for b in bins:
+        input_ids, labels, position_ids = [], [], []
+        for i in b:
+            ids = examples["input_ids"][i]
+            input_ids.extend(ids)
+            labels.append(-100)
+            labels.extend(examples["labels"][i][1:])
+            position_ids.extend(range(len(ids)))
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["position_ids"].append(position_ids)
+    return packed
+
+
+class PackedDataCollator(object):
+    """
+    Right-pads packed sequences to the longest in the batch.
+
+    With `block_diagonal_mask` (for eager / sdpa attention) the attention_mask is a
+    (batch, 1, length, length) additive mask that is causal within each packed example and
+    blocks attention across examples, so an example sees only its own tokens. It costs
+    4 * length**2 bytes per row. flash_attention_2 does not take 4D masks; without
+    `block_diagonal_mask` no attention_mask is returned and the model separates the examples
+    by where position_ids restart at 0.
+    """
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: int = 8, block_diagonal_mask: bool = True):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.block_diagonal_mask = block_diagonal_mask
+
+    def __call__(self, features: List[Dict[str, List[int]]]) -> Dict[str, torch.Tensor]:
+        length = max(len(f["input_ids"]) for f in features)
+        length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        batch = {"input_ids": [], "labels": [], "position_ids": []}
+        for f in features:
+            pad = length - len(f["input_ids"])
+            batch["input_ids"].append(list(f["input_ids"]) + [self.pad_token_id] * pad)
+            batch["labels"].append(list(f["labels"]) + [-100] * pad)
+            batch["position_ids"].append(list(f["position_ids"]) + list(range(pad)))
+        batch = {k: torch.tensor(v, dtype=torch.long) for k, v in batch.items()}
+        if self.block_diagonal_mask:
+            batch["attention_mask"] = block_diagonal_mask(batch["position_ids"])
+        return batch
+
+
+def block_diagonal_mask(position_ids: torch.Tensor, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    # (batch, 1, length, length) additive mask: 0 where a token may attend (an earlier or the
+    # same token of its own example), the dtype's minimum elsewhere. Examples start where
+    # position_ids restart at 0; the padding is one more example, so no row is fully masked.
+    segments = torch.cumsum(position_ids == 0, dim=-1)
+    length = position_ids.shape[-1]
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    allowed = causal & (segments[:, :, None] == segments[:, None, :])
+    mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def padding_efficiency(lengths: Sequence[int], batch_size: int) -> float:
+    # real tokens / tokens computed when consecutive rows are batched and padded to the longest
+    total = 0
+    for s in range(0, len(lengths), batch_size):
+        batch = lengths[s:s + batch_size]
+        total += max(batch) * len(batch)
+    return sum(lengths) / max(total, 1)
+
+
+def packing_report(lengths: Sequence[int], packed_lengths: Sequence[int], batch_size: int, seed: int = 42) -> Dict[str, float]:
+    # padding efficiency of shuffled batches before and after packing
+    rng = random.Random(seed)
+    lengths = list(lengths)
+    packed_lengths = list(packed_lengths)
+    rng.shuffle(lengths)
+    rng.shuffle(packed_lengths)
+    before = padding_efficiency(lengths, batch_size)
+    after = padding_efficiency(packed_lengths, batch_size)
+    return {
+        "examples": len(lengths),
+        "packed_sequences": len(packed_lengths),
+        "tokens": sum(lengths),
+        "padding_efficiency_before": before,
+        "padding_efficiency_after": after,
+        "steps_per_epoch_before": -(-len(lengths) // batch_size),
+        "steps_per_epoch_after": -(-len(packed_lengths) // batch_size),
+    }
@@ -0,0 +1,100 @@
+"""
+Batched instruction-data tokenization with a disk cache, for finetune.py.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, List, Sequence
+
+from .prompter import Prompter
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    # the full serialized tokenizer for fast tokenizers, otherwise its name and vocab
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = f"{tokenizer.name_or_path}:{len(tokenizer)}:{sorted(tokenizer.get_vocab().items())[:1000]}"
+    special = json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)
+    return hashlib.sha256(f"{state}:{special}".encode()).hexdigest()
+
+
+def count_prefix_tokens(offsets: Sequence[Sequence[int]], prefix_chars: int) -> int:
+    # tokens that start inside the first prefix_chars characters (special tokens have offset (0, 0))
+    n = 0
+    for start, _ in offsets:
+        if start >= prefix_chars:
+            break
+        n += 1
+    return n
+
+
+def make_tokenize_function(
+    tokenizer,
+    prompter: Prompter,
+    train_on_inputs: bool = True,
+) -> Callable[[Dict[str, List[Any]]], Dict[str, List[List[int]]]]:
+    # batched version of generate_and_tokenize_prompt: each full prompt is tokenized once and
+    # always ends with eos, and with train_on_inputs=False the user-prompt length comes from
+    # the token offsets instead of a second tokenization of the user prompt
+    use_offsets = getattr(tokenizer, "is_fast", False)
+
+    def tokenize_batch(batch):
+        user_prompts = [
+            prompter.generate_prompt(instruction, input)
+            for instruction, input in zip(batch["instruction"], batch["input"])
+        ]
+        full_prompts = [
+            prompter.generate_prompt(instruction, input, output)
+            for instruction, input, output in zip(batch["instruction"], batch["input"], batch["output"])
+        ]
+        result = tokenizer(full_prompts, return_offsets_mapping=use_offsets and not train_on_inputs)
+        if not train_on_inputs and not use_offsets:
+            user_lengths = [len(ids) for ids in tokenizer(user_prompts)["input_ids"]]
+
+        out = {"input_ids": [], "attention_mask": [], "length": []}
+        if not train_on_inputs:
+            out["labels"] = []
+        for i, input_ids in enumerate(result["input_ids"]):
+            input_ids = list(input_ids)
+            if input_ids[-1] != tokenizer.eos_token_id:
+                input_ids.append(tokenizer.eos_token_id)
+            out["input_ids"].append(input_ids)
+            out["attention_mask"].append([1] * len(input_ids))
+            out["length"].append(len(input_ids))
+            if not train_on_inputs:
+                if use_offsets:
+                    user_prompt_len = count_prefix_tokens(result["offset_mapping"][i], len(user_prompts[i]))
+                else:
+                    user_prompt_len = user_lengths[i]
+                out["labels"].append([-100] * user_prompt_len + input_ids[user_prompt_len:])
+        return out
+
+    return tokenize_batch
+
+
+def cached_map(dataset, function: Callable, cache_dir: str, key: Sequence[Any], **map_kwargs):
+    # dataset.map(function, batched=True) saved under cache_dir, keyed by the dataset fingerprint
+    # and `key` (template, tokenizer and options); a later run with the same key just loads it
+    from datasets import load_from_disk
+
+    digest = hashlib.sha256(
+        json.dumps([dataset._fingerprint, *key], sort_keys=True, default=str).encode()
+    ).hexdigest()[:32]
+    path = os.path.join(cache_dir, f"tokenized-{digest}")
+    if os.path.exists(os.path.join(path, "dataset_info.json")):
+        print("Loading tokenized dataset from: ", path)
+        return load_from_disk(path)
+
+    mapped = dataset.map(function, batched=True, remove_columns=dataset.column_names, **map_kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + f".tmp{os.getpid()}"
+    mapped.save_to_disk(tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process saved the same dataset first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return load_from_disk(path)
@@ -7,6 +7,8 @@ import os
 import os.path as osp
 from typing import Union
 
+from .prompt_tokenizer import PromptTokenizer  # noqa: F401  (re-exported)
+
 
 class Prompter(object):
     __slots__ = ("template", "_verbose")
@@ -54,4 +56,4 @@ class Prompter(object):
         return res
 
     def get_response(self, output: str) -> str:
-        return output.split(self.template["response_split"])[1].strip()
\ No newline at end of file
+        return output.split(self.template["response_split"])[1].strip()
@@ -0,0 +1,102 @@
+import threading
+import time
+from pathlib import Path
+
+from code.utils.batching import RequestBatcher, group_requests, trim_at_stop
+
+# copy of code/utils/batching.py shipped with the CTranslate2 handler
+CTRANSLATE2_COPY = (
+    Path(__file__).resolve().parents[6]
+    / "inference" / "deploy-endpoint" / "CTranslate2" / "scripts" / "code" / "batching.py"
+)
+
+
+class TestBatching():
+
+    def test_group_requests(self):
+        requests = [
+            {"instruction": "a", "input": "", "max_new_tokens": 16, "stop_ids": [0]},
+            {"instruction": "b", "input": "", "max_new_tokens": 64, "temperature": 0.7},
+            {"instruction": "c", "input": "x", "max_new_tokens": 32, "stop_ids": [1, 2]},
+        ]
+        assert group_requests(requests) == [[0, 2], [1]], "Only the generation kwargs should split groups"
+        per_row = ("instruction", "input", "max_new_tokens")
+        assert group_requests(requests, per_row) == [[0], [1], [2]], "stop_ids should split groups when not per row"
+
+    def test_trim_at_stop(self):
+        assert trim_at_stop([5, 6, 2, 7, 2], [2], 10) == [5, 6, 2]
+        assert trim_at_stop([5, 6, 2, 7, 2], [2], 2) == [5, 6]
+        assert trim_at_stop([5, 6, 7], [], 10) == [5, 6, 7]
+
+    def test_request_batcher(self):
+        batches = []
+        running = threading.Event()
+        queued = threading.Event()
+
+        def batch_fn(requests):
+            # hold the first batch until every request is queued behind it
+            running.set()
+            queued.wait()
+            batches.append(list(requests))
+            return [r * 10 for r in requests]
+
+        batcher = RequestBatcher(batch_fn, max_batch_size=4, max_wait_ms=200)
+        results = {}
+
+        def call(i):
+            results[i] = batcher.submit(i)
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(6)]
+        threads[0].start()
+        running.wait()
+        for t in threads[1:]:
+            t.start()
+        while batcher._queue.qsize() < 5:
+            time.sleep(0.001)
+        queued.set()
+        for t in threads:
+            t.join()
+
+        assert results == {i: i * 10 for i in range(6)}, "Each caller should get its own result"
+        assert [len(b) for b in batches] == [1, 4, 1], "Queued requests should be grouped up to max_batch_size"
+        assert batcher.map([7, 8]) == [70, 80]
+        metrics = batcher.metrics()
+        assert metrics["batches"] == len(batches) == 4
+        assert metrics["batch_fill"]["count"] == metrics["batches"]
+        assert metrics["queue_wait_ms"]["count"] == 8
+
+    def test_request_batcher_wait_window(self):
+        batches = []
+
+        def batch_fn(requests):
+            batches.append(list(requests))
+            return requests
+
+        batcher = RequestBatcher(batch_fn, max_batch_size=4, max_wait_ms=500)
+        first = threading.Thread(target=batcher.submit, args=(1,))
+        first.start()
+        time.sleep(0.05)
+        assert batcher.submit(2) == 2
+        first.join()
+        assert batches == [[1, 2]], "A request arriving within the wait window should join the batch"
+
+    def test_request_batcher_no_wait(self):
+        batcher = RequestBatcher(lambda requests: requests, max_batch_size=4, max_wait_ms=0)
+        start = time.monotonic()
+        assert batcher.submit(1) == 1
+        assert time.monotonic() - start < 1, "max_wait_ms=0 should run a lone request at once"
+
+    def test_request_batcher_error(self):
+        def batch_fn(requests):
+            raise ValueError("boom")
+
+        batcher = RequestBatcher(batch_fn, max_batch_size=2, max_wait_ms=1)
+        try:
+            batcher.submit(1)
+            assert False, "The batch error should reach the caller"
+        except ValueError as e:
+            assert str(e) == "boom"
+
+    def test_copies_in_sync(self):
+        source = Path(__file__).resolve().parents[2] / "code" / "utils" / "batching.py"
+        assert CTRANSLATE2_COPY.read_text() == source.read_text(), "Copy code/utils/batching.py to the CTranslate2 handler"
@@ -0,0 +1,39 @@
+import random
+from code.utils.bucketing import LengthBucketBatchSampler, bucketing_report
+
+
+class TestBucketing():
+
+    def test_batches_cover_dataset(self):
+        rng = random.Random(0)
+        lengths = [rng.randint(10, 1000) for _ in range(1000)]
+        sampler = LengthBucketBatchSampler(lengths, batch_size=8)
+        batches = list(sampler)
+        assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+        assert len(batches) == len(sampler) == 125
+        assert list(sampler) != batches, "Each epoch should be reshuffled"
+
+    def test_token_budget(self):
+        rng = random.Random(0)
+        lengths = [rng.randint(10, 1000) for _ in range(1000)]
+        sampler = LengthBucketBatchSampler(lengths, batch_size=8, max_tokens=2048)
+        batches = sampler.batches(0)
+        assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+        assert all(len(b) == 1 or len(b) * max(lengths[i] for i in b) <= 2048 for b in batches)
+        assert {len(sampler.batches(epoch)) for epoch in range(5)} == {len(sampler)}, \
+            "Every epoch should have the len() batches the Trainer planned for"
+        assert sampler.batches(1) != batches, "The batch order should be reshuffled"
+
+    def test_distributed(self):
+        lengths = list(range(1, 102))
+        shards = [LengthBucketBatchSampler(lengths, 4, num_replicas=3, rank=r).batches(0) for r in range(3)]
+        assert len({len(s) for s in shards}) == 1, "Every rank should get the same number of batches"
+        seen = [i for s in shards for b in s for i in b]
+        assert set(seen) == set(range(len(lengths)))
+
+    def test_report(self):
+        rng = random.Random(0)
+        lengths = [rng.choice([20, 1000]) for _ in range(512)]
+        report = bucketing_report(lengths, batch_size=8)
+        assert report["padding_efficiency_bucketed"] > report["padding_efficiency_random"]
+        assert report["compute_reduction"] > 1
@@ -0,0 +1,89 @@
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+from code.utils.decoding import ContinuousBatcher, DecodeMetrics
+
+VOCAB = 13
+
+# copy of code/utils/decoding.py shipped with the DJL handler
+DJL_COPY = Path(__file__).resolve().parents[3] / "djl_scripts" / "decoding.py"
+
+
+class SumModel(torch.nn.Module):
+    # next token = (sum of every attended token + position of the last one) % VOCAB, with the
+    # tokens kept in a tuple past_key_values so padding mistakes change the output
+    def __init__(self):
+        super().__init__()
+        self.dummy = torch.nn.Parameter(torch.zeros(1))
+
+    def forward(self, input_ids, attention_mask, position_ids, past_key_values=None, use_cache=True):
+        k = input_ids.float().view(input_ids.size(0), 1, -1, 1)
+        if past_key_values is not None:
+            k = torch.cat([past_key_values[0][0], k], dim=2)
+        total = (k[:, 0, :, 0] * attention_mask).sum(dim=1).long() + position_ids[:, -1]
+        logits = torch.nn.functional.one_hot(total % VOCAB, VOCAB).float()
+        return SimpleNamespace(logits=logits.unsqueeze(1), past_key_values=((k, k),))
+
+
+class Tokenizer():
+    eos_token_id = None
+
+    def __call__(self, text, **kwargs):
+        return {"input_ids": [int(c) for c in text]}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " ".join(str(i) for i in ids)
+
+
+def reference(prompt, max_new_tokens, stop_ids=()):
+    ids = [int(c) for c in prompt]
+    out = []
+    while len(out) < max_new_tokens:
+        token = (sum(ids) + len(ids) - 1) % VOCAB
+        ids.append(token)
+        out.append(token)
+        if token in stop_ids:
+            break
+    return " ".join(str(i) for i in out)
+
+
+class TestContinuousBatcher():
+
+    def test_matches_sequential_decoding(self):
+        batcher = ContinuousBatcher(SumModel(), Tokenizer(), max_batch_size=3)
+        prompts = ["123", "4567891", "2", "98765432101234", "55", "31415"]
+        budgets = [5, 12, 3, 8, 20, 7]
+        results = {}
+
+        def call(i):
+            results[i] = batcher.submit(prompts[i], max_new_tokens=budgets[i])
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(len(prompts))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for i in range(len(prompts)):
+            assert results[i] == reference(prompts[i], budgets[i]), f"Request {i} does not match"
+        assert batcher.metrics.finished == len(prompts)
+
+    def test_stop_ids(self):
+        batcher = ContinuousBatcher(SumModel(), Tokenizer(), max_batch_size=2)
+        expected = reference("123", 50, stop_ids=[0])
+        assert batcher.submit("123", max_new_tokens=50, stop_ids=[0]) == expected
+        assert expected.split()[-1] == "0"
+
+    def test_metrics(self):
+        metrics = DecodeMetrics(max_batch_size=4)
+        metrics.record_step(4)
+        metrics.record_step(2)
+        snapshot = metrics.snapshot()
+        assert snapshot["steps"] == 2 and snapshot["tokens"] == 6
+        assert snapshot["slot_occupancy"] == 0.75
+
+    def test_copies_in_sync(self):
+        source = Path(__file__).resolve().parents[2] / "code" / "utils" / "decoding.py"
+        assert DJL_COPY.read_text() == source.read_text(), "Copy code/utils/decoding.py to djl_scripts/decoding.py"
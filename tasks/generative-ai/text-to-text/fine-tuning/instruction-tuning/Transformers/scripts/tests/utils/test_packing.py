@@ -0,0 +1,89 @@
+import random
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from code.utils.packing import PackedDataCollator, pack_examples, pack_ffd, packing_report
+
+
+def naive_ffd(lengths, max_len):
+    bins, free = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        for b in range(len(bins)):
+            if free[b] >= lengths[i]:
+                bins[b].append(i)
+                free[b] -= lengths[i]
+                break
+        else:
+            bins.append([i])
+            free.append(max_len - lengths[i])
+    return bins
+
+
+def batch_feature(length):
+    return {"input_ids": [1] * length, "labels": [1] * length, "position_ids": list(range(length))}
+
+
+class TestPacking():
+
+    def test_pack_ffd(self):
+        rng = random.Random(0)
+        lengths = [rng.randint(1, 256) for _ in range(500)]
+        bins = pack_ffd(lengths, 256)
+        assert bins == naive_ffd(lengths, 256), "Should match a plain first-fit-decreasing"
+        assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+        assert all(sum(lengths[i] for i in b) <= 256 for b in bins)
+
+    def test_pack_examples(self):
+        examples = {
+            "input_ids": [[1, 2, 3], [4, 5], [6, 7, 8, 9]],
+            "labels": [[-100, 2, 3], [4, 5], [-100, -100, 8, 9]],
+        }
+        packed = pack_examples(examples, 6)
+        assert packed["input_ids"] == [[6, 7, 8, 9, 4, 5], [1, 2, 3]]
+        assert packed["labels"] == [[-100, -100, 8, 9, -100, 5], [-100, 2, 3]]
+        assert packed["position_ids"] == [[0, 1, 2, 3, 0, 1], [0, 1, 2]]
+
+    def test_collator(self):
+        collator = PackedDataCollator(pad_token_id=0, pad_to_multiple_of=4)
+        batch = collator([
+            {"input_ids": [1, 2, 3, 4, 5], "labels": [-100, 2, 3, 4, 5], "position_ids": [0, 1, 2, 0, 1]},
+            {"input_ids": [6, 7], "labels": [-100, 7], "position_ids": [0, 1]},
+        ])
+        assert batch["input_ids"].shape == (2, 8)
+        assert batch["labels"][1].tolist() == [-100, 7] + [-100] * 6
+        allowed = batch["attention_mask"][:, 0] == 0
+        assert batch["attention_mask"].shape == (2, 1, 8, 8)
+        assert allowed[0, 4].tolist() == [False, False, False, True, True, False, False, False]
+        assert allowed[0, 2].tolist() == [True, True, True, False, False, False, False, False]
+        assert allowed[1, 1].tolist() == [True, True, False, False, False, False, False, False]
+        assert allowed.any(dim=-1).all(), "Padding rows should not be fully masked"
+        assert "attention_mask" not in PackedDataCollator(0, block_diagonal_mask=False)([batch_feature(3)])
+
+    def test_packed_examples_do_not_attend_to_each_other(self):
+        torch.manual_seed(0)
+        collator = PackedDataCollator(pad_token_id=0)
+        for attn_implementation in ["eager", "sdpa"]:
+            config = LlamaConfig(
+                vocab_size=32, hidden_size=16, intermediate_size=32, num_hidden_layers=2,
+                num_attention_heads=2, num_key_value_heads=2, attn_implementation=attn_implementation,
+            )
+            model = LlamaForCausalLM(config).eval()
+
+            def logits(a, b):
+                batch = collator([{"input_ids": a + b, "labels": a + b, "position_ids": [0, 1, 2, 0, 1]}])
+                batch.pop("labels")
+                with torch.no_grad():
+                    return model(**batch).logits[0, 3:5]
+
+            b = [4, 5]
+            with torch.no_grad():
+                alone = model(input_ids=torch.tensor([b])).logits[0]
+            assert torch.allclose(logits([1, 2, 3], b), logits([7, 8, 9], b), atol=1e-5), attn_implementation
+            assert torch.allclose(logits([1, 2, 3], b), alone, atol=1e-5), attn_implementation
+
+    def test_packing_report(self):
+        report = packing_report([10, 100, 10, 100], [110, 110], batch_size=2)
+        assert report["padding_efficiency_after"] == 1.0
+        assert report["padding_efficiency_before"] < 1.0
+        assert report["steps_per_epoch_after"] == 1
@@ -0,0 +1,57 @@
+from datasets import Dataset
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from code.utils.prompter import Prompter
+from code.utils.preprocessing import cached_map, count_prefix_tokens, make_tokenize_function
+
+RECORDS = {
+    "instruction": ["Where is the capital of Japan?", "Add the numbers.", "Say hello."],
+    "input": ["", "1234 + 5678", ""],
+    "output": ["Tokyo", "6912", "Hello!"],
+}
+
+
+def make_tokenizer():
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    text = [f"{i} {x} {o}" for i, x, o in zip(*RECORDS.values())] * 10
+    tokenizer.train_from_iterator(text, trainers.BpeTrainer(
+        vocab_size=300, special_tokens=["<eos>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+
+
+def reference(tokenizer, prompter, record):
+    # the per-example tokenization finetune.py used to do, with two tokenizer calls
+    full = tokenizer(prompter.generate_prompt(record["instruction"], record["input"], record["output"]))["input_ids"]
+    full = full + [tokenizer.eos_token_id]
+    user_len = len(tokenizer(prompter.generate_prompt(record["instruction"], record["input"]))["input_ids"])
+    return full, [-100] * user_len + full[user_len:]
+
+
+class TestPreprocessing():
+
+    def test_count_prefix_tokens(self):
+        assert count_prefix_tokens([(0, 0), (0, 3), (3, 5), (5, 9)], 5) == 3
+        assert count_prefix_tokens([(0, 3), (3, 5)], 0) == 0
+
+    def test_tokenize_function(self):
+        tokenizer = make_tokenizer()
+        prompter = Prompter(template_name="simple_qa")
+        tokenize_batch = make_tokenize_function(tokenizer, prompter, train_on_inputs=False)
+        out = tokenize_batch(RECORDS)
+        for i in range(len(RECORDS["output"])):
+            record = {k: v[i] for k, v in RECORDS.items()}
+            input_ids, labels = reference(tokenizer, prompter, record)
+            assert out["input_ids"][i] == input_ids
+            assert out["labels"][i] == labels
+
+    def test_cached_map(self, tmp_path):
+        tokenizer = make_tokenizer()
+        tokenize_batch = make_tokenize_function(tokenizer, Prompter(template_name="simple_qa"))
+        dataset = Dataset.from_dict(RECORDS)
+        first = cached_map(dataset, tokenize_batch, str(tmp_path), ["simple_qa"])
+        second = cached_map(dataset, lambda batch: 1 / 0, str(tmp_path), ["simple_qa"])
+        assert first["input_ids"] == second["input_ids"], "The second call should load from the cache"
+        assert len(list(tmp_path.iterdir())) == 1
@@ -1,5 +1,15 @@
+import re
 import unittest
-from code.utils.prompter import Prompter
+from pathlib import Path
+
+from code.utils.prompter import Prompter, PromptTokenizer
+
+# copies of code/utils/prompt_tokenizer.py shipped with the DJL and CTranslate2 handlers
+HANDLER_COPIES = [
+    Path(__file__).resolve().parents[3] / "djl_scripts" / "prompt_tokenizer.py",
+    Path(__file__).resolve().parents[6]
+    / "inference" / "deploy-endpoint" / "CTranslate2" / "scripts" / "code" / "prompt_tokenizer.py",
+]
 
 
 class TestPrompter():
@@ -40,3 +50,74 @@ class TestPrompter():
         )
         
         assert label == prompter.get_response(prompt), "Label does not match the expected one"
+
+
+class WordTokenizer():
+    # splits like GPT-2's byte-level pre-tokenizer (a leading space joins the next word, a
+    # whitespace run before a word keeps all but its last space), so ids depend on the split
+    PATTERN = re.compile(r" ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+    def __init__(self):
+        self.vocab = {}
+        self.calls = []
+
+    def encode(self, text, add_special_tokens=False):
+        self.calls.append(text)
+        return [self.vocab.setdefault(piece, len(self.vocab)) for piece in self.PATTERN.findall(self.prepare(text))]
+
+    def prepare(self, text):
+        return text
+
+
+class PrefixSpaceTokenizer(WordTokenizer):
+    # adds a space in front of every call, like SentencePiece, so no prompt can be split
+
+    def prepare(self, text):
+        return " " + text
+
+
+CASES = [
+    ("Where is Tokyo?", "Japan"),
+    ("Where is Tokyo?", None),
+    ("trailing space ", "trailing space "),
+    (" leading space", "\nleading newline"),
+    ("?!", "'quoted'"),
+    ("1234", "日本の首都"),
+]
+
+
+class TestPromptTokenizer():
+
+    def test_matches_full_prompt(self):
+        for template_name in ["alpaca", "simple_qa", "simple_qa_ja", "rinna"]:
+            prompter = Prompter(template_name=template_name)
+            for tokenizer in [WordTokenizer(), PrefixSpaceTokenizer()]:
+                prompt_tokenizer = PromptTokenizer(prompter, tokenizer)
+                for instruction, _input in CASES:
+                    expected = tokenizer.encode(prompter.generate_prompt(instruction, _input))
+                    assert expected == prompt_tokenizer.encode(instruction, _input), \
+                        f"{template_name}, {type(tokenizer).__name__}: {instruction!r}, {_input!r}"
+
+    def test_piecewise(self):
+        tokenizer = WordTokenizer()
+        prompt_tokenizer = PromptTokenizer(Prompter(template_name="alpaca"), tokenizer)
+        assert prompt_tokenizer.piecewise
+        tokenizer.calls.clear()
+        prompt_tokenizer.encode("Where is Tokyo?", "Japan")
+        assert tokenizer.calls == ["Where is Tokyo?", "Japan"], "Only the fields should be tokenized"
+        tokenizer.calls.clear()
+        prompt_tokenizer.encode(" leading space", "Japan")
+        assert len(tokenizer.calls) == 1, "A whitespace edge should tokenize the whole prompt"
+        assert not PromptTokenizer(Prompter(template_name="alpaca"), PrefixSpaceTokenizer()).piecewise
+
+    def test_cache(self):
+        prompt_tokenizer = PromptTokenizer(Prompter(template_name="simple_qa"), WordTokenizer(), cache_size=2)
+        for _ in range(3):
+            prompt_tokenizer.encode("Where is Tokyo?", "Japan")
+        info = prompt_tokenizer._encode.cache_info()
+        assert info.hits == 4 and info.currsize == 2
+
+    def test_copies_in_sync(self):
+        source = Path(__file__).resolve().parents[2] / "code" / "utils" / "prompt_tokenizer.py"
+        for copy in HANDLER_COPIES:
+            assert copy.read_text() == source.read_text(), f"Copy code/utils/prompt_tokenizer.py to {copy}"
@@ -0,0 +1,159 @@
+"""
+Helpers to serve several generation requests with a single batched `generate` call.
+
+The same file is shipped as batching.py next to the CTranslate2 handler; keep the two copies
+identical (tests/utils/test_batching.py checks this).
+"""
+
+import bisect
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+# request fields that may differ between the rows of one `generate` call
+PER_ROW_FIELDS = ("instruction", "input", "stop_ids", "max_new_tokens")
+
+
+def generation_key(request: Dict[str, Any], per_row: Sequence[str] = PER_ROW_FIELDS) -> str:
+    # requests can share a `generate` call when everything except the per-row fields matches
+    kwargs = {k: v for k, v in request.items() if k not in per_row}
+    return json.dumps(kwargs, sort_keys=True, default=str)
+
+
+def group_requests(requests: Sequence[Dict[str, Any]], per_row: Sequence[str] = PER_ROW_FIELDS) -> List[List[int]]:
+    # indices of `requests` grouped by generation_key, in order of first appearance
+    groups: Dict[str, List[int]] = {}
+    for i, request in enumerate(requests):
+        groups.setdefault(generation_key(request, per_row), []).append(i)
+    return list(groups.values())
+
+
+def trim_at_stop(tokens: Sequence[int], stop_ids: Sequence[int], max_new_tokens: int) -> List[int]:
+    # a row's own output: at most max_new_tokens, cut right after its first stop id
+    tokens = list(tokens[:max_new_tokens])
+    stop_ids = set(stop_ids)
+    for i, token in enumerate(tokens):
+        if token in stop_ids:
+            return tokens[:i + 1]
+    return tokens
+
+
+class Histogram(object):
+    """Counts of observed values per upper bound (the last bucket is unbounded)."""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"le_{bound:g}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {"count": self.total, "mean": self.sum / max(self.total, 1), "buckets": buckets}
+
+
+class RequestBatcher(object):
+    """
+    Queues single requests from concurrent callers and runs them through `batch_fn`
+    (a list of requests -> a list of results, in the same order) in groups of up to
+    `max_batch_size`. The worker waits up to `max_wait_ms` after the first request of a batch,
+    so requests arriving within that window share its batch; `max_wait_ms=0` opts out and
+    runs whatever is already queued at once.
+
+    Requests reach the queue concurrently only when `predict_fn` is called from several
+    threads of one process. Clients can also send a list of requests, which predict_fn runs
+    as one batch.
+
+    Queue-wait (ms) and batch-fill (batch size / max_batch_size) histograms are available
+    from `metrics()` and printed every `metrics_every` batches.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10,
+        metrics_every: int = 0,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics_every = metrics_every
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.queue_wait_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+        self.batch_fill = Histogram([0.125, 0.25, 0.5, 0.75, 1.0])
+        self._queue: "queue.Queue[Tuple[Any, Future, float]]" = queue.Queue()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, request: Any) -> Any:
+        # blocks until the batch containing `request` is done; re-raises its error
+        return self.map([request])[0]
+
+    def map(self, requests: Sequence[Any]) -> List[Any]:
+        futures = []
+        for request in requests:
+            future: Future = Future()
+            self._queue.put((request, future, time.monotonic()))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "queue_wait_ms": self.queue_wait_ms.snapshot(),
+                "batch_fill": self.batch_fill.snapshot(),
+            }
+
+    def _next_batch(self) -> List[Tuple[Any, Future, float]]:
+        # the first request, then whatever arrives within max_wait of it (up to max_batch_size)
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _record(self, batch: List[Tuple[Any, Future, float]]):
+        now = time.monotonic()
+        with self.lock:
+            self.batches += 1
+            self.batch_fill.observe(len(batch) / self.max_batch_size)
+            for _, _, queued in batch:
+                self.queue_wait_ms.observe((now - queued) * 1000)
+            log = self.metrics_every > 0 and self.batches % self.metrics_every == 0
+        if log:
+            print("Batch metrics:", self.metrics())
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            self._record(batch)
+            try:
+                results = self.batch_fn([request for request, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
@@ -1,10 +1,13 @@
 import os, json
-from typing import Union
+from typing import Any, Dict, List, Sequence, Tuple, Union
 
 import ctranslate2
 import transformers
 import torch
 
+from batching import RequestBatcher, group_requests
+from prompt_tokenizer import PromptTokenizer
+
 class Prompter(object):
 
     def __init__(self, prompt_input: str = "", prompt_no_input: str = ""):
@@ -29,7 +32,7 @@ class Prompter(object):
             )
         return res
 
-    
+
 def load_model(
     tokenizer: str = "",
     model: str = "",
@@ -45,8 +48,26 @@ def load_model(
     generator = ctranslate2.Generator(model, device=device)
     tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer)
     prompter = Prompter(prompt_input, prompt_no_input)
+    prompt_tokenizer = PromptTokenizer(prompter, tokenizer)
+    accepts_ids = generator_accepts_ids(generator)
+
+    return tokenizer, generator, prompt_tokenizer, accepts_ids
+
 
-    return tokenizer, generator, prompter
+def generator_accepts_ids(generator) -> bool:
+    # whether this ctranslate2 release's generate_batch takes token ids, or only token strings
+    try:
+        generator.generate_batch([[0]], max_length=1)
+    except TypeError:
+        return False
+    return True
+
+
+def start_tokens(model_objects, prompt_ids: List[List[int]]):
+    tokenizer, _, _, accepts_ids = model_objects
+    if accepts_ids:
+        return prompt_ids
+    return [tokenizer.convert_ids_to_tokens(ids) for ids in prompt_ids]
 
 
 def inference(
@@ -57,22 +78,15 @@ def inference(
     stop_ids=[],
     **kwargs,
 ):
-    tokenizer, generator, prompter = model_objects
+    tokenizer, generator, prompt_tokenizer, _ = model_objects
     
     if instruction != "":
-        prompt = prompter.generate_prompt(instruction, input)
+        prompt_ids = prompt_tokenizer.encode(instruction, input)
     else:
-        prompt = input
+        prompt_ids = prompt_tokenizer.encode_text(input)
     
-    tokens = tokenizer.convert_ids_to_tokens(
-        tokenizer.encode(
-            prompt,
-            add_special_tokens=False,
-        )
-    )
-
     results = generator.generate_batch(
-        [tokens],
+        start_tokens(model_objects, [prompt_ids]),
         max_length=max_new_tokens,
         include_prompt_in_result=False,
         end_token=stop_ids,
@@ -91,33 +105,95 @@ def inference_batch(
     stop_ids=[],
     **kwargs,
 ):
-    tokenizer, generator, prompter = model_objects
+    tokenizer, generator, _, _ = model_objects
     
     prompt = input
     
-    tokens = [tokenizer.tokenize(text, add_special_tokens=False) for text in prompt]
+    # one call into the fast tokenizer for the whole batch
+    prompt_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
 
     results = generator.generate_batch(
-        tokens,
+        start_tokens(model_objects, prompt_ids),
         max_length=max_new_tokens,
         include_prompt_in_result=False,
         end_token=stop_ids,
         **kwargs
     )
 
-    text = [tokenizer.decode(result.sequences_ids[0]) for result in results]
+    text = tokenizer.batch_decode([result.sequences_ids[0] for result in results])
     return text
 
 
+# request fields that may differ between the rows of one generate_batch call (end_token is
+# per call, so stop_ids is not one of them)
+PER_ROW_FIELDS = ("instruction", "input", "max_new_tokens")
+
+
+def inference_requests(
+    model_objects,
+    requests: Sequence[Dict[str, Any]],
+    max_batch_size: int = 0,
+) -> List[str]:
+    # one generate_batch call per group of compatible requests, prompts sorted by token
+    # length; each row runs to the largest max_new_tokens of its group and is cut back to its own
+    tokenizer, generator, prompt_tokenizer, _ = model_objects
+    texts: List[str] = [""] * len(requests)
+    for indices in group_requests(requests, PER_ROW_FIELDS):
+        prompt_ids = {}
+        for i in indices:
+            instruction = requests[i].get("instruction")
+            input = requests[i].get("input")
+            if instruction != "":
+                prompt_ids[i] = prompt_tokenizer.encode(instruction, input)
+            else:
+                prompt_ids[i] = prompt_tokenizer.encode_text(input)
+        indices = sorted(indices, key=lambda i: len(prompt_ids[i]))
+        budgets = [requests[i].get("max_new_tokens", 128) for i in indices]
+        kwargs = {
+            k: v for k, v in requests[indices[0]].items()
+            if k not in ("instruction", "input", "max_new_tokens", "stop_ids")
+        }
+        results = generator.generate_batch(
+            start_tokens(model_objects, [prompt_ids[i] for i in indices]),
+            max_batch_size=max_batch_size,
+            max_length=max(budgets),
+            include_prompt_in_result=False,
+            end_token=requests[indices[0]].get("stop_ids", []),
+            **kwargs
+        )
+        decoded = tokenizer.batch_decode([
+            result.sequences_ids[0][:budget] for result, budget in zip(results, budgets)
+        ])
+        for i, text in zip(indices, decoded):
+            texts[i] = text
+    return texts
+
+
 def model_fn(
     model_dir
 ):
     model_params = json.loads(os.environ['model_params'])
     print(model_params)
+    # max_batch_size > 1 queues concurrent predict_fn calls and runs up to that many prompts
+    # per generate_batch; requests arriving within batch_wait_ms of the first one share its
+    # batch (batch_wait_ms=0 runs every request at once). Clients can also send a list of
+    # inputs, which runs as one batch (see batching.RequestBatcher)
+    max_batch_size = model_params.pop("max_batch_size", None)
+    batch_wait_ms = model_params.pop("batch_wait_ms", 10)
+    metrics_every = model_params.pop("metrics_every", 100)
     try:
-        return load_model(**model_params)
+        model_objects = load_model(**model_params)
     except Exception as e:
         print("Model error:", e)
+        return None
+    if max_batch_size and max_batch_size > 1:
+        return RequestBatcher(
+            lambda requests: inference_requests(model_objects, requests, max_batch_size=max_batch_size),
+            max_batch_size=max_batch_size,
+            max_wait_ms=batch_wait_ms,
+            metrics_every=metrics_every,
+        )
+    return model_objects
 
 
 def input_fn(input_data, content_type):
@@ -134,6 +210,13 @@ def predict_fn(
     print("Predict Fn")
     print(data)
     try:
+        if isinstance(model, RequestBatcher):
+            if type(data["input"]) == list:
+                # raw prompts without template, as in inference_batch
+                return model.map([
+                    {**data, "instruction": "", "input": text} for text in data["input"]
+                ])
+            return model.submit(data)
         if type(data["input"]) == list:
             return inference_batch(
                 model_objects=model,
@@ -0,0 +1,159 @@
+"""
+Cached prompt tokenization for the inference handlers.
+
+The same file is shipped as prompt_tokenizer.py next to the DJL and CTranslate2 handlers; keep
+the copies identical (tests/utils/test_prompter.py checks this).
+"""
+
+import unicodedata
+from functools import lru_cache
+from string import Formatter
+from typing import Dict, FrozenSet, List, Optional, Tuple, Union
+
+# probe values per edge character class, used to check each template boundary at construction
+PROBES = {
+    "ascii_letter": ("a", "Tokyo", "I"),
+    "letter": ("東京", "日本の首都", "é"),
+    "number": ("7", "1234", "５"),
+    "symbol": ("?", "'", "(", "。", "」", "!?"),
+}
+NEUTRAL = "Tokyo"
+
+
+def edge_class(ch: str) -> Optional[str]:
+    # class of a field's first / last character; None (whitespace) is never joined piecewise,
+    # since whitespace runs are split differently depending on what follows them
+    if ch.isspace():
+        return None
+    category = unicodedata.category(ch)[0]
+    if category == "L":
+        return "ascii_letter" if ch.isascii() else "letter"
+    if category == "N":
+        return "number"
+    return "symbol"
+
+
+class PromptTokenizer(object):
+    """
+    Builds prompt token ids from a Prompter (any object with `generate_prompt` and a
+    `template` dict). The ids are always those of
+    tokenizer.encode(prompter.generate_prompt(instruction, input)) that training used.
+
+    The static template segments are tokenized once and, per request, only the instruction /
+    input are tokenized, through a bounded LRU. Joining ids at a segment boundary is only
+    exact when the tokenizer never merges across it: byte-level BPE can merge a field's edge
+    whitespace or punctuation with the template text, and SentencePiece adds a prefix space
+    per call. So at construction every boundary is probed with each class of edge character
+    (`PROBES`), checking that encode(text before it) + encode(text after it) equals the ids of
+    the whole probe prompt; a request is joined piecewise only when the edge classes of its
+    fields passed at every boundary. Any other request (or any request, when a boundary never
+    passes, e.g. with SentencePiece) tokenizes the whole prompt, through the same LRU keyed by
+    the prompt text.
+    """
+
+    def __init__(self, prompter, tokenizer, cache_size: int = 4096):
+        self.prompter = prompter
+        self.tokenizer = tokenizer
+        self._encode = lru_cache(maxsize=cache_size)(self._encode_uncached)
+        self._segments = {}
+        self._safe: Dict[str, List[FrozenSet[Tuple[str, str]]]] = {}
+        for name in ("prompt_input", "prompt_no_input"):
+            self._segments[name] = self._split(prompter.template[name])
+            self._safe[name] = self._probe_boundaries(name)
+
+    @property
+    def piecewise(self) -> bool:
+        # whether any request can be joined piecewise
+        return any(safe and all(safe) for safe in self._safe.values())
+
+    def _encode_uncached(self, text: str) -> Tuple[int, ...]:
+        return tuple(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _split(self, template: str) -> List[Tuple[str, str, Tuple[int, ...]]]:
+        # ("text", literal, its ids) for static text, ("field", name, ()) for {instruction} / {input}
+        segments = []
+        for literal, field, _, _ in Formatter().parse(template):
+            if literal:
+                segments.append(("text", literal, self._encode_uncached(literal)))
+            if field is not None:
+                segments.append(("field", field, ()))
+        return segments
+
+    def _boundary_classes(self, name: str, fields: Dict[str, str]) -> Optional[List[Tuple[str, str]]]:
+        # (left, right) edge classes at each boundary next to a field; "static" for template
+        # text. None when a field is empty or has a whitespace edge.
+        segments = self._segments[name]
+        for kind, value, _ in segments:
+            if kind == "field" and not fields[value]:
+                return None
+        classes = []
+        for (kind_a, a, _), (kind_b, b, _) in zip(segments, segments[1:]):
+            left = edge_class(fields[a][-1]) if kind_a == "field" else "static"
+            right = edge_class(fields[b][0]) if kind_b == "field" else "static"
+            if left is None or right is None:
+                return None
+            classes.append((left, right))
+        return classes
+
+    def _join(self, name: str, fields: Dict[str, str]) -> List[int]:
+        ids = []
+        for kind, value, static_ids in self._segments[name]:
+            ids.extend(static_ids if kind == "text" else self._encode(fields[value]))
+        return ids
+
+    def _probe_boundaries(self, name: str) -> List[FrozenSet[Tuple[str, str]]]:
+        # for each boundary, the (left, right) class pairs for which splitting every probe
+        # prompt there gives the ids of the whole prompt
+        segments = self._segments[name]
+        safe = []
+        for i, ((kind_a, a, _), (kind_b, b, _)) in enumerate(zip(segments, segments[1:])):
+            lefts = list(PROBES) if kind_a == "field" else ["static"]
+            rights = list(PROBES) if kind_b == "field" else ["static"]
+            passed = set()
+            for left in lefts:
+                for right in rights:
+                    if all(self._splits_exactly(name, i + 1, fields) for fields in self._probe_fields(
+                        a if kind_a == "field" else None, left, b if kind_b == "field" else None, right
+                    )):
+                        passed.add((left, right))
+            safe.append(frozenset(passed))
+        return safe
+
+    def _splits_exactly(self, name: str, boundary: int, fields: Dict[str, str]) -> bool:
+        texts = [value if kind == "text" else fields[value] for kind, value, _ in self._segments[name]]
+        prefix, suffix = "".join(texts[:boundary]), "".join(texts[boundary:])
+        if self._encode_uncached(prefix) + self._encode_uncached(suffix) != self._encode_uncached(prefix + suffix):
+            return False
+        # equal ids can be luck of the vocabulary (no merge learned across the boundary); with
+        # a fast tokenizer also require the pre-tokenizer to split there, so no merge can apply
+        backend = getattr(self.tokenizer, "backend_tokenizer", None)
+        pre_tokenizer = getattr(backend, "pre_tokenizer", None)
+        if pre_tokenizer is None:
+            return True
+        ends = {end for _, (_, end) in pre_tokenizer.pre_tokenize_str(prefix + suffix)}
+        return len(prefix) in ends
+
+    @staticmethod
+    def _probe_fields(left_field, left, right_field, right):
+        # field values ending with each `left` probe and starting with each `right` probe
+        n = max(len(PROBES.get(left, ())), len(PROBES.get(right, ())))
+        for k in range(n):
+            fields = {"instruction": NEUTRAL, "input": NEUTRAL}
+            if left_field is not None:
+                fields[left_field] = NEUTRAL + PROBES[left][k % len(PROBES[left])]
+            if right_field is not None:
+                fields[right_field] = PROBES[right][k % len(PROBES[right])] + NEUTRAL
+            yield fields
+
+    def encode(self, instruction: str, input: Union[None, str] = None) -> List[int]:
+        # same ids as tokenizer.encode(prompter.generate_prompt(instruction, input))
+        name = "prompt_input" if input else "prompt_no_input"
+        fields = {"instruction": instruction, "input": input}
+        classes = self._boundary_classes(name, fields)
+        if classes is not None and all(pair in safe for pair, safe in zip(classes, self._safe[name])):
+            return self._join(name, fields)
+        return list(self._encode(self.prompter.generate_prompt(instruction, input)))
+
+    def encode_text(self, text: str) -> List[int]:
+        # a raw prompt without template (requests with an empty instruction)
+        return list(self._encode(text))